@@ -0,0 +1,525 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+
+"""Pack a finished night of recordings (raw audio, analysed audio and motion images) into fixed-size tar.zst shards"""
+# Each shard is a normal tar archive compressed with zstd (zstd -d <shard> | tar x works), but the zstd stream is made of
+# many independent frames which are compressed in parallel. The index file written next to each shard gives, for every
+# file, the byte offset of the frame its tar entry starts in, so one file can be extracted by decompressing from that frame
+# only. Packing is resumable: finished shards are recorded in the night's manifest and their files are skipped on restart.
+# Source files only become eligible for deletion once the shard holding them has been verified.
+
+import argparse
+import collections
+import datetime
+import hashlib
+import json
+import os
+import re
+import sys
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import zstandard
+
+
+CONFIG_FILE = '/home/bird-pi/ami_setup/system_config.JSON'
+
+TAR_BLOCK = 512
+
+# ===========================================================================================================================
+
+### Selecting the files of a night ###
+
+def read_conf_option(conf_file, option):
+    """Returns the value of an option in a motion config file, or None if it is not set (or the file can't be read)."""
+    try:
+        lines = Path(conf_file).read_text().splitlines()
+    except OSError:
+        return None
+    for line in lines:
+        parts = line.split(None, 1)
+        if len(parts) == 2 and parts[0] == option:
+            return parts[1].strip()
+    return None
+
+
+def motion_target_dirs(config):
+    """
+    Returns the directories motion saves images to, read from motion.conf and the camera config files it includes.
+
+    Parameters
+    ----------
+    config : dict
+        Content of system_config.JSON. 'motion_conf' in the 'archive' section is the path to motion.conf (default
+        /etc/motion/motion.conf), 'motion_target_dir' is used if motion.conf doesn't set a target_dir.
+
+    Returns
+    -------
+    list of pathlib.Path
+        Existing target directories, without duplicates or directories inside another one.
+    """
+    motion_conf = config['archive'].get('motion_conf', '/etc/motion/motion.conf')
+    default_dir = read_conf_option(motion_conf, 'target_dir') or config['archive'].get('motion_target_dir')
+    target_dirs = [default_dir] if default_dir else []
+
+    try:
+        lines = Path(motion_conf).read_text().splitlines()
+    except OSError:
+        lines = []
+    for line in lines:
+        parts = line.split()
+        if len(parts) >= 2 and parts[0] == 'camera': # each camera can save somewhere else
+            target_dirs.append(read_conf_option(parts[1], 'target_dir'))
+
+    found = sorted({Path(target_dir).resolve() for target_dir in target_dirs if target_dir and Path(target_dir).is_dir()})
+    return [path for path in found if not any(parent in found for parent in path.parents)]
+
+
+def night_sources(config, night):
+    """
+    Returns the files belonging to a night, sorted, as (name inside the archive, path on disk) pairs.
+
+    Parameters
+    ----------
+    config : dict
+        Content of system_config.JSON.
+    night : datetime.date
+        Date the night starts on. Audio is stored in directories named after the date (e.g. raw_audio/2023_2_8) and
+        motion images (anywhere under motion's target directories) are taken from 12:00 on that date to 12:00 the next day.
+
+    Returns
+    -------
+    list of tuple
+        (archive name, pathlib.Path) for each file.
+    """
+    date_dir = "%s_%s_%s" % (night.year, night.month, night.day)
+    raw_audio = Path(config['birds']['directory_to_save_audio'])
+    audio_dirs = {'raw_audio': raw_audio / date_dir,
+                  'analysed_audio': raw_audio.parent / 'analysed_audio' / date_dir}
+
+    files = []
+    for label, directory in audio_dirs.items():
+        if directory.is_dir():
+            for path in directory.rglob('*'):
+                if path.is_file() and not path.is_symlink():
+                    files.append((label + '/' + date_dir + '/' + path.relative_to(directory).as_posix(), path))
+
+    # motion saves pictures and movies under target_dir, named after the time they were taken (picture_filename
+    # %Y_%m_%d/%Y%m%d%H%M%S-%q-%v), so use the 14 digit time stamp in the file name to pick out the night
+    start = datetime.datetime.combine(night, datetime.time(12))
+    end = start + datetime.timedelta(days=1)
+    target_dirs = motion_target_dirs(config)
+    for target_dir in target_dirs:
+        prefix = 'motion/' if len(target_dirs) == 1 else 'motion/' + target_dir.name + '/'
+        for path in target_dir.rglob('*'):
+            match = re.search(r'(?<!\d)(\d{14})(?!\d)', path.name)
+            if match and path.is_file() and not path.is_symlink():
+                try:
+                    taken = datetime.datetime.strptime(match.group(1), '%Y%m%d%H%M%S')
+                except ValueError: # 14 digits that aren't a time stamp
+                    continue
+                if start <= taken < end:
+                    files.append((prefix + path.relative_to(target_dir).as_posix(), path))
+
+    return sorted(files)
+
+# ===========================================================================================================================
+
+### Building the tar stream in frames ###
+
+def tar_frames(files, frame_size):
+    """
+    Generator splitting the tar stream of the files into chunks of about frame_size bytes.
+
+    Parameters
+    ----------
+    files : list of tuple
+        (archive name, pathlib.Path) for each file, as returned by night_sources.
+    frame_size : int
+        Uncompressed size of each chunk (chunks can be up to twice this so that only files larger than a frame are split
+        over several chunks). The last chunk of a file that was split is always cut short so the next tar header starts a
+        new chunk, which means a shard can end after any file larger than a frame and not just after runs of small files.
+
+    Yields
+    ------
+    frame : bytes
+        Uncompressed tar bytes.
+    entries : list of dict
+        Index entries for the files whose tar header is in this frame ('offset_in_frame' is where the file data starts,
+        which may be past the end of the frame). The 'sha256' is filled in once the whole file has been read.
+    at_boundary : bool
+        True if the frame starts with a tar header, i.e. a shard can end just before it.
+    """
+    buf, entries, at_boundary = bytearray(), [], True
+    for name, path in files:
+        if buf and not at_boundary: # tail of a split file, the next header has to start a chunk
+            yield bytes(buf), entries, at_boundary
+            buf, entries, at_boundary = bytearray(), [], True
+        st = path.stat()
+        info = tarfile.TarInfo(name)
+        info.size, info.mtime, info.mode = st.st_size, int(st.st_mtime), 0o644
+        buf += info.tobuf(format=tarfile.PAX_FORMAT)
+        entry = {'name': name, 'source': str(path), 'size': st.st_size, 'mtime': st.st_mtime,
+                 'offset_in_frame': len(buf)}
+        entries.append(entry)
+
+        digest = hashlib.sha256()
+        remaining = st.st_size
+        with path.open('rb') as fp:
+            while remaining:
+                if len(buf) >= frame_size:
+                    yield bytes(buf), entries, at_boundary
+                    buf, entries, at_boundary = bytearray(), [], False
+                chunk = fp.read(min(remaining, frame_size)) # files smaller than a frame are never split
+                if not chunk:
+                    raise OSError("{path} shrank while being packed".format(path=path))
+                digest.update(chunk)
+                buf += chunk
+                remaining -= len(chunk)
+        entry['sha256'] = digest.hexdigest()
+        buf += bytes(-st.st_size % TAR_BLOCK)
+
+        if len(buf) >= frame_size:
+            yield bytes(buf), entries, at_boundary
+            buf, entries, at_boundary = bytearray(), [], True
+    if buf:
+        yield bytes(buf), entries, at_boundary
+
+# ===========================================================================================================================
+
+### Manifest ###
+
+def load_manifest(manifest_file, night):
+    if manifest_file.exists():
+        with manifest_file.open() as fp:
+            return json.load(fp)
+    return {'night': night.isoformat(), 'complete': False, 'shards': []}
+
+
+def save_manifest(manifest_file, manifest):
+    tmp_file = manifest_file.with_name(manifest_file.name + '.tmp')
+    with tmp_file.open('w') as fp:
+        json.dump(manifest, fp, indent=3)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_file, manifest_file)
+
+
+def index_file(shard_file):
+    return shard_file.with_name(shard_file.name + '.index.json')
+
+# ===========================================================================================================================
+
+### Packing ###
+
+class ShardWriter:
+    """
+    Writes compressed frames into numbered shards, starting a new shard at the first tar header after shard_size compressed
+    bytes are reached (so a shard is over shard_size by at most the last file in it).
+
+    Parameters
+    ----------
+    out_dir : pathlib.Path
+        Directory the shards, their index files and the manifest are written to.
+    prefix : str
+        Shard file name prefix e.g. 'LID_test__SID_test__2023_2_8'.
+    shard_size : int
+        Target compressed size of each shard in bytes.
+    manifest : dict
+        Night manifest, updated (and saved to manifest_file) each time a shard is finished.
+    manifest_file : pathlib.Path
+        Where to save the manifest.
+    eof_frame : bytes
+        Compressed tar end-of-archive marker, written at the end of every shard.
+    """
+
+    def __init__(self, out_dir, prefix, shard_size, manifest, manifest_file, eof_frame):
+        self.out_dir, self.prefix, self.shard_size = out_dir, prefix, shard_size
+        self.manifest, self.manifest_file, self.eof_frame = manifest, manifest_file, eof_frame
+        self.number = max((shard['number'] + 1 for shard in manifest['shards']), default=0)
+        self.fp = None
+
+    def write(self, frame, entries, at_boundary):
+        if self.fp is not None and at_boundary and self.position >= self.shard_size:
+            self.close()
+        if self.fp is None:
+            self.path = self.out_dir / "{prefix}__{number:04d}.tar.zst".format(prefix=self.prefix, number=self.number)
+            self.fp = self.path.open('wb')
+            self.position, self.entries, self.digest = 0, [], hashlib.sha256()
+        for entry in entries:
+            entry['frame_offset'] = self.position
+        self.entries.extend(entries)
+        self._write(frame)
+
+    def _write(self, data):
+        self.fp.write(data)
+        self.digest.update(data)
+        self.position += len(data)
+
+    def close(self):
+        if self.fp is None:
+            return
+        self._write(self.eof_frame)
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.fp.close()
+        self.fp = None
+
+        index = {'shard': self.path.name, 'size': self.position, 'sha256': self.digest.hexdigest(), 'files': self.entries}
+        with index_file(self.path).open('w') as fp:
+            json.dump(index, fp)
+        self.manifest['shards'].append({'name': self.path.name, 'number': self.number, 'verified': False,
+                                        'files': [entry['name'] for entry in self.entries]})
+        save_manifest(self.manifest_file, self.manifest)
+        self.number += 1
+
+
+def pack_night(config, night, workers=None):
+    """
+    Pack (or carry on packing) a night into shards.
+
+    Parameters
+    ----------
+    config : dict
+        Content of system_config.JSON.
+    night : datetime.date
+        Night to pack, see night_sources.
+    workers : int, optional
+        Number of frames compressed at the same time. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    manifest : dict
+        The night manifest once all the files have been packed.
+    """
+    archive = config['archive']
+    out_dir = Path(archive['directory_to_save_archives']) / night.isoformat()
+    out_dir.mkdir(parents=True, exist_ok=True)
+    manifest_file = out_dir / 'manifest.json'
+    manifest = load_manifest(manifest_file, night)
+
+    # Anything not in the manifest is a shard that was interrupted part way through - throw it away and redo its files
+    known = {shard['name'] for shard in manifest['shards']}
+    for path in out_dir.glob('*.tar.zst*'):
+        if path.name.split('.index.json')[0] not in known:
+            path.unlink()
+
+    packed = {name for shard in manifest['shards'] for name in shard['files']}
+    files = [(name, path) for name, path in night_sources(config, night) if name not in packed]
+
+    workers = workers or os.cpu_count() or 1
+    level = archive.get('compression_level', 3)
+    frame_size = int(archive.get('frame_size_mb', 4) * 1024 * 1024)
+    shard_size = int(archive.get('shard_size_mb', 512) * 1024 * 1024)
+    prefix = config['system']['LID'] + "__" + config['system']['SID'] + "__" + "%s_%s_%s" % (night.year, night.month, night.day)
+    eof_frame = zstandard.ZstdCompressor(level=level).compress(bytes(2 * TAR_BLOCK))
+    writer = ShardWriter(out_dir, prefix, shard_size, manifest, manifest_file, eof_frame)
+
+    def compress(frame):
+        # ZstdCompressor objects can't be shared between threads; compress() releases the GIL so threads run in parallel
+        return zstandard.ZstdCompressor(level=level, write_checksum=True).compress(frame)
+
+    # Keep only a few frames per worker in memory at once, written out in order as they finish
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for frame, entries, at_boundary in tar_frames(files, frame_size):
+            pending.append((pool.submit(compress, frame), entries, at_boundary))
+            while len(pending) > 2 * workers:
+                future, entries, at_boundary = pending.popleft()
+                writer.write(future.result(), entries, at_boundary)
+        while pending:
+            future, entries, at_boundary = pending.popleft()
+            writer.write(future.result(), entries, at_boundary)
+    writer.close()
+
+    manifest['complete'] = True
+    save_manifest(manifest_file, manifest)
+    return manifest
+
+# ===========================================================================================================================
+
+### Reading, verifying and deleting ###
+
+def extract_file(shard_file, entry, out_fp):
+    """
+    Copy one file out of a shard, only decompressing from the frame its tar entry starts in.
+
+    Parameters
+    ----------
+    shard_file : pathlib.Path
+        Shard containing the file.
+    entry : dict
+        The file's entry from the shard index.
+    out_fp : file object
+        Opened in binary mode, the file data is written here.
+    """
+    with open(shard_file, 'rb') as fp:
+        fp.seek(entry['frame_offset'])
+        reader = zstandard.ZstdDecompressor().stream_reader(fp, read_across_frames=True)
+        to_skip, remaining = entry['offset_in_frame'], entry['size']
+        while to_skip:
+            to_skip -= len(reader.read(min(to_skip, 1024 * 1024)))
+        while remaining:
+            chunk = reader.read(min(remaining, 1024 * 1024))
+            if not chunk:
+                raise EOFError("{shard} ended before {name}".format(shard=shard_file, name=entry['name']))
+            out_fp.write(chunk)
+            remaining -= len(chunk)
+
+
+def verify_shard(shard_file):
+    """
+    Check a shard against its index: the shard checksum, that it decompresses to a valid tar archive, and the checksum of
+    every file in it.
+
+    Parameters
+    ----------
+    shard_file : pathlib.Path
+        Shard to check.
+
+    Returns
+    -------
+    bool
+        True if the shard is complete and undamaged.
+    """
+    with index_file(shard_file).open() as fp:
+        index = json.load(fp)
+
+    digest = hashlib.sha256()
+    with open(shard_file, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+            digest.update(chunk)
+    if digest.hexdigest() != index['sha256']:
+        return False
+
+    expected = {entry['name']: entry['sha256'] for entry in index['files']}
+    found = {}
+    try:
+        with open(shard_file, 'rb') as fp:
+            reader = zstandard.ZstdDecompressor().stream_reader(fp, read_across_frames=True)
+            with tarfile.open(fileobj=reader, mode='r|') as tar:
+                for member in tar:
+                    file_digest = hashlib.sha256()
+                    data = tar.extractfile(member)
+                    for chunk in iter(lambda: data.read(1024 * 1024), b''):
+                        file_digest.update(chunk)
+                    found[member.name] = file_digest.hexdigest()
+    except (tarfile.TarError, zstandard.ZstdError):
+        return False
+    return found == expected
+
+
+def verify_night(out_dir):
+    """
+    Verify every shard of a night that has not been verified yet. Shards that fail are deleted and removed from the
+    manifest so their files are packed again on the next run.
+
+    Parameters
+    ----------
+    out_dir : pathlib.Path
+        Directory holding the night's shards and manifest.
+
+    Returns
+    -------
+    bool
+        True if all shards are good.
+    """
+    manifest_file = out_dir / 'manifest.json'
+    with manifest_file.open() as fp:
+        manifest = json.load(fp)
+
+    good = []
+    for shard in manifest['shards']:
+        shard_file = out_dir / shard['name']
+        if not shard['verified']:
+            shard['verified'] = shard_file.exists() and index_file(shard_file).exists() and verify_shard(shard_file)
+        if shard['verified']:
+            good.append(shard)
+        else:
+            for path in (shard_file, index_file(shard_file)):
+                if path.exists():
+                    path.unlink()
+
+    ok = len(good) == len(manifest['shards'])
+    manifest['shards'] = good
+    manifest['complete'] = manifest['complete'] and ok
+    save_manifest(manifest_file, manifest)
+    return ok
+
+
+def deletable_files(out_dir):
+    """
+    Returns the source files that are safely archived: their shard has been verified and the file has not changed since
+    it was packed.
+
+    Parameters
+    ----------
+    out_dir : pathlib.Path
+        Directory holding the night's shards and manifest.
+
+    Returns
+    -------
+    list of pathlib.Path
+        Source files that can be deleted.
+    """
+    with (out_dir / 'manifest.json').open() as fp:
+        manifest = json.load(fp)
+
+    eligible = []
+    for shard in manifest['shards']:
+        if not shard['verified']:
+            continue
+        with index_file(out_dir / shard['name']).open() as fp:
+            index = json.load(fp)
+        for entry in index['files']:
+            path = Path(entry['source'])
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            if st.st_size == entry['size'] and st.st_mtime == entry['mtime']:
+                eligible.append(path)
+    return eligible
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--date', help='night to pack as year_month_day e.g. 2023_2_8 (default: yesterday)')
+    parser.add_argument('--config', default=CONFIG_FILE, help='path to system_config.JSON')
+    parser.add_argument('--workers', type=int, help='number of compression threads (default: number of CPUs)')
+    parser.add_argument('--delete', action='store_true', help='delete source files once their shard has been verified')
+    args = parser.parse_args()
+
+    with open(args.config) as fp:
+        config = json.load(fp)
+
+    if args.date:
+        night = datetime.datetime.strptime(args.date, '%Y_%m_%d').date()
+    else:
+        night = datetime.date.today() - datetime.timedelta(days=1)
+    # The night runs until 12:00 the next day so only pack it once that has passed
+    if datetime.datetime.now() < datetime.datetime.combine(night + datetime.timedelta(days=1), datetime.time(12)):
+        print("Night of {night} has not finished yet".format(night=night))
+        return 1
+
+    manifest = pack_night(config, night, args.workers)
+    out_dir = Path(config['archive']['directory_to_save_archives']) / night.isoformat()
+    print("Packed {files} files into {shards} shards in {out_dir}".format(
+        files=sum(len(shard['files']) for shard in manifest['shards']), shards=len(manifest['shards']), out_dir=out_dir))
+
+    if not verify_night(out_dir):
+        print("Some shards failed verification and have been removed - their files will be packed again on the next run")
+        return 1
+    print("All shards verified")
+
+    if args.delete:
+        files = deletable_files(out_dir)
+        for path in files:
+            path.unlink()
+        print("Deleted {count} archived source files".format(count=len(files)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
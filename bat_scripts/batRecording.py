@@ -12,6 +12,7 @@ __author__ = 'Grace Skinner'
 from pathlib import Path # pathlib part of python standard library. Used to make new directories
 import datetime # datetime part of python standard library. Used to get date and time 
 import subprocess # Used to run bash arecord from python
+import sys # Used to exit with an error if arecord hangs
 #import birdconfig # Used to configure settings for bird recording. Access variables defined in birdconfig.py
 import json # Used to configure settings for bird recording. Access variables defined in system_config.JSON
 
@@ -83,7 +84,14 @@ print("Start recording with arecord > rec_proc pid = " + str(rec_proc.pid))
 print("Start recording with arecord > recording started")
 
 # Make sure it waits for the recording to be complete before moving on
-rec_proc.wait()
+# Don't wait forever - if arecord hangs (e.g. the mic has been unplugged) stop it so the next recording can start
+try:
+	rec_proc.wait(timeout=int(system_variables['birds']['duration']) + 60)
+except subprocess.TimeoutExpired:
+	rec_proc.kill()
+	rec_proc.wait()
+	print("Stop recording with arecord > arecord did not finish in time and was killed")
+	sys.exit(1)
 
 # Final verbose
 print("Stop recording with arecord > Recording stopped") 
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+
+"""Benchmark detectBatCalls.py on synthetic bat recordings: how many known calls it finds (and how many it makes up), and its throughput in recorded hours per CPU-hour"""
+# Writes a set of 384 kHz S32_LE recordings (like batRecording.py makes) containing background noise and frequency
+# modulated calls at known times, then runs the detector over them with the same process pool as a real night.
+
+import argparse
+import datetime
+import sys
+import tempfile
+import time
+import wave
+from pathlib import Path
+
+import numpy as np
+
+from detectBatCalls import DEFAULT_SETTINGS, detect_night
+
+
+def write_recording(wav_file, seconds, rate, call_times, rng):
+    """
+    Write a synthetic recording with a frequency modulated call (80 -> 40 kHz over 4 ms) at each of the call times.
+
+    Parameters
+    ----------
+    wav_file : pathlib.Path
+        File to write.
+    seconds : float
+        Length of the recording.
+    rate : int
+        Sampling rate in Hz.
+    call_times : numpy.ndarray
+        Start time of each call in seconds.
+    rng : numpy.random.Generator
+        Source of the background noise.
+    """
+    signal = rng.normal(0, 0.01, int(seconds * rate)).astype(np.float32)
+    t = np.arange(int(0.004 * rate)) / rate
+    chirp = 0.1 * np.sin(2 * np.pi * (80e3 * t - (40e3 / 0.004) * t ** 2 / 2)) * np.hanning(len(t))
+    for start in call_times:
+        i = int(start * rate)
+        signal[i:i + len(chirp)] += chirp[:len(signal) - i]
+
+    with wave.open(str(wav_file), 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(4)
+        wav.setframerate(rate)
+        wav.writeframes((np.clip(signal, -1, 1) * (2 ** 31 - 1)).astype('<i4').tobytes())
+
+
+def match_calls(found, planted, tolerance):
+    """
+    Match detected call start times to the planted ones, each planted call being matched at most once.
+
+    Parameters
+    ----------
+    found : list of float
+        Start times of the detected calls in seconds.
+    planted : numpy.ndarray
+        Start times of the calls written into the recording, sorted.
+    tolerance : float
+        Largest difference in seconds between a detection and the call it is matched to.
+
+    Returns
+    -------
+    hits, misses, false_positives : int
+        Planted calls that were found, planted calls that were not, and detections that don't match a planted call.
+    """
+    matched = np.zeros(len(planted), bool)
+    false_positives = 0
+    for start in sorted(found):
+        # nearest planted call not yet matched
+        candidates = np.flatnonzero(~matched & (np.abs(planted - start) <= tolerance))
+        if len(candidates):
+            matched[candidates[np.abs(planted[candidates] - start).argmin()]] = True
+        else:
+            false_positives += 1
+    return int(matched.sum()), int((~matched).sum()), false_positives
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=8, help='number of recordings')
+    parser.add_argument('--seconds', type=float, default=60, help='length of each recording (batRecording.py makes 60s files)')
+    parser.add_argument('--workers', type=int, help='number of processes (default: number of CPUs)')
+    parser.add_argument('--tolerance-ms', type=float, default=5, help='how far a detection can be from a planted call to count as finding it')
+    args = parser.parse_args()
+
+    rate = 384000
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        wav_files, planted = [], {}
+        start = datetime.datetime(2023, 6, 1, 22, 0, 0)
+        for i in range(args.files):
+            # calls in passes of 10, 80 ms apart, like a bat flying past
+            passes = rng.uniform(0, args.seconds - 1, max(int(args.seconds / 10), 1))
+            call_times = np.sort((passes[:, None] + 0.08 * np.arange(10)).ravel())
+            call_times = call_times[call_times < args.seconds - 0.01]
+            taken = start + datetime.timedelta(minutes=i)
+            wav_file = Path(tmp_dir) / "LID_test__SID_test__HID_test__{t.year}_{t.month}_{t.day}__{t.hour}_{t.minute}_{t.second}.wav".format(t=taken)
+            write_recording(wav_file, args.seconds, rate, call_times, rng)
+            wav_files.append(wav_file)
+            planted[wav_file.name] = call_times
+
+        wall_start = time.monotonic()
+        events, recorded_s, cpu_s, _ = detect_night(wav_files, DEFAULT_SETTINGS, args.workers)
+        wall_s = time.monotonic() - wall_start
+
+    hits = misses = false_positives = 0
+    for name, call_times in planted.items():
+        found = [event['start_s'] for event in events if event['file'] == name]
+        file_hits, file_misses, file_false_positives = match_calls(found, call_times, args.tolerance_ms * 1e-3)
+        hits, misses, false_positives = hits + file_hits, misses + file_misses, false_positives + file_false_positives
+
+    print("Calls: {planted} in the recordings, {found} detected".format(planted=sum(map(len, planted.values())), found=len(events)))
+    print("Hits: {hits}, misses: {misses}, false positives: {false_positives} (within {tolerance:g} ms)".format(
+        hits=hits, misses=misses, false_positives=false_positives, tolerance=args.tolerance_ms))
+    print("Recorded: {hours:.3f} hours, CPU: {cpu:.1f}s, wall: {wall:.1f}s".format(hours=recorded_s / 3600, cpu=cpu_s, wall=wall_s))
+    print("Throughput: {rate:.1f} recorded hours per CPU-hour".format(rate=recorded_s / cpu_s))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
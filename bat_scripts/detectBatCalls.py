@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+
+"""Find bat echolocation calls in a night of bat recordings and write them to a per-night event table"""
+# Each recording is read in fixed-size chunks, so memory use does not depend on the length of the recording. Every chunk
+# is turned into a spectrogram in one go (numpy), each spectrogram frame is compared against the chunk's background noise
+# level in the bat band, and runs of loud frames become calls. Recordings are processed in parallel, one per CPU.
+
+import argparse
+import csv
+import datetime
+import json
+import os
+import re
+import sys
+import time
+import wave
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+
+CONFIG_FILE = '/home/bird-pi/ami_setup/system_config.JSON'
+
+# Used when the setting is missing from the 'detector' part of the 'bats' section of system_config.JSON
+DEFAULT_SETTINGS = {
+    'min_sampling_rate': 192000, # files recorded below this rate are bird recordings, skip them
+    'chunk_seconds': 2,
+    'fft_size': 512,
+    'hop_size': 256,
+    'min_frequency_khz': 15,
+    'max_frequency_khz': 120,
+    'threshold_db': 15,
+    'max_gap_ms': 1,
+    'min_duration_ms': 1.5,
+    'max_duration_ms': 50,
+}
+
+EVENT_COLUMNS = ['file', 'start_time', 'start_s', 'duration_ms', 'peak_khz', 'min_khz', 'max_khz', 'snr_db']
+
+# ===========================================================================================================================
+
+### Reading recordings ###
+
+def read_chunks(wav_file, chunk_frames):
+    """
+    Generator reading a WAV file (first channel only) in chunks.
+
+    Parameters
+    ----------
+    wav_file : str or pathlib.Path
+        PCM WAV file, e.g. as written by arecord (S16_LE, S24_LE or S32_LE).
+    chunk_frames : int
+        Number of samples per chunk.
+
+    Yields
+    ------
+    numpy.ndarray
+        float32 samples scaled to -1..1.
+    """
+    with wave.open(str(wav_file), 'rb') as wav:
+        width, channels = wav.getsampwidth(), wav.getnchannels()
+        dtype = {1: np.uint8, 2: '<i2', 3: '<i4', 4: '<i4'}[width]
+        scale = float(2 ** (8 * (4 if width == 3 else width) - 1))
+        while True:
+            raw = wav.readframes(chunk_frames)
+            if not raw:
+                break
+            if width == 3: # no numpy 24 bit type, put each sample in the top 3 bytes of a 32 bit one
+                raw = np.pad(np.frombuffer(raw, np.uint8).reshape(-1, 3), ((0, 0), (1, 0))).tobytes()
+            samples = np.frombuffer(raw, dtype)[::channels].astype(np.float32)
+            if width == 1: # 8 bit WAV is unsigned
+                samples -= 128
+            yield samples / scale
+
+
+def recording_start(wav_file):
+    """
+    Returns the start time of a recording from its file name (LID__SID__HID__year_month_day__hour_minute_second.wav).
+
+    Parameters
+    ----------
+    wav_file : pathlib.Path
+        Recording to get the start time of.
+
+    Returns
+    -------
+    datetime or None
+        Start time, or None if the file name doesn't follow the naming scheme.
+    """
+    match = re.search(r'(\d+)_(\d+)_(\d+)__(\d+)_(\d+)_(\d+)\.wav$', wav_file.name)
+    if match is None:
+        return None
+    return datetime.datetime(*map(int, match.groups()))
+
+# ===========================================================================================================================
+
+### Detecting calls ###
+
+class CallDetector:
+    """
+    Streaming bat call detector. Feed it consecutive chunks of one recording with add_chunk() and then call finish().
+
+    Parameters
+    ----------
+    sampling_rate : int
+        Sampling rate of the recording in Hz.
+    settings : dict
+        Detector settings, see DEFAULT_SETTINGS.
+    """
+
+    def __init__(self, sampling_rate, settings):
+        self.rate = sampling_rate
+        self.nfft, self.hop = settings['fft_size'], settings['hop_size']
+        self.window = np.hanning(self.nfft).astype(np.float32)
+        freqs = np.fft.rfftfreq(self.nfft, 1 / sampling_rate)
+        self.band = (freqs >= settings['min_frequency_khz'] * 1e3) & (freqs <= settings['max_frequency_khz'] * 1e3)
+        self.freqs_khz = freqs[self.band] / 1e3
+        self.threshold_db = settings['threshold_db']
+        self.max_gap = max(int(settings['max_gap_ms'] * 1e-3 * sampling_rate / self.hop), 1)
+        self.min_duration_s = settings['min_duration_ms'] * 1e-3
+        self.max_duration_s = settings['max_duration_ms'] * 1e-3
+
+        self.tail = np.zeros(0, np.float32) # samples not yet covered by a whole spectrogram frame
+        self.frame_offset = 0 # index of the first frame of the next chunk
+        self.open_call = None # call still going at the end of the last chunk
+        self.calls = []
+
+    def add_chunk(self, samples):
+        """Detect calls in the next chunk of samples."""
+        x = np.concatenate([self.tail, samples])
+        if len(x) < self.nfft:
+            self.tail = x
+            return
+        frames = np.lib.stride_tricks.sliding_window_view(x, self.nfft)[::self.hop]
+        self.tail = x[len(frames) * self.hop:]
+
+        power = np.abs(np.fft.rfft(frames * self.window, axis=1)[:, self.band]) ** 2
+        noise = np.median(power, axis=0) + 1e-20 # background level of each frequency over the chunk
+        ratio = power / noise
+        peak_bin = ratio.argmax(axis=1)
+        snr_db = 10 * np.log10(ratio[np.arange(len(frames)), peak_bin])
+        frame_power = power[np.arange(len(frames)), peak_bin]
+
+        active = np.flatnonzero(snr_db >= self.threshold_db)
+        if len(active):
+            # split the loud frames into runs, allowing gaps of up to max_gap frames inside a call
+            breaks = np.flatnonzero(np.diff(active) > self.max_gap) + 1
+            for run in np.split(active, breaks):
+                self._add_run(run, peak_bin, snr_db, frame_power)
+
+        self.frame_offset += len(frames)
+        if self.open_call is not None and self.open_call['last'] < self.frame_offset - self.max_gap:
+            self._close_call()
+
+    def _add_run(self, run, peak_bin, snr_db, frame_power):
+        loudest = run[frame_power[run].argmax()]
+        freqs = self.freqs_khz[peak_bin[run]]
+        run_call = {'first': self.frame_offset + run[0], 'last': self.frame_offset + run[-1],
+                    'peak_power': frame_power[loudest], 'peak_khz': self.freqs_khz[peak_bin[loudest]],
+                    'min_khz': freqs.min(), 'max_khz': freqs.max(), 'snr_db': snr_db[run].max()}
+
+        call = self.open_call
+        if call is not None and run_call['first'] - call['last'] <= self.max_gap: # carries on from the last chunk
+            if run_call['peak_power'] > call['peak_power']:
+                call['peak_power'], call['peak_khz'] = run_call['peak_power'], run_call['peak_khz']
+            call['last'] = run_call['last']
+            call['min_khz'] = min(call['min_khz'], run_call['min_khz'])
+            call['max_khz'] = max(call['max_khz'], run_call['max_khz'])
+            call['snr_db'] = max(call['snr_db'], run_call['snr_db'])
+        else:
+            if call is not None:
+                self._close_call()
+            self.open_call = run_call
+
+    def _close_call(self):
+        call, self.open_call = self.open_call, None
+        start_s = call['first'] * self.hop / self.rate
+        duration_s = ((call['last'] - call['first']) * self.hop + self.nfft) / self.rate
+        if self.min_duration_s <= duration_s <= self.max_duration_s:
+            self.calls.append({'start_s': round(float(start_s), 5), 'duration_ms': round(float(duration_s) * 1e3, 2),
+                               'peak_khz': round(float(call['peak_khz']), 2), 'min_khz': round(float(call['min_khz']), 2),
+                               'max_khz': round(float(call['max_khz']), 2), 'snr_db': round(float(call['snr_db']), 1)})
+
+    def finish(self):
+        """Close any call still open at the end of the recording and return all calls found."""
+        if self.open_call is not None:
+            self._close_call()
+        return self.calls
+
+
+def detect_file(wav_file, settings):
+    """
+    Find the calls in one recording.
+
+    Parameters
+    ----------
+    wav_file : pathlib.Path
+        Recording to analyse.
+    settings : dict
+        Detector settings, see DEFAULT_SETTINGS.
+
+    Returns
+    -------
+    events : list of dict
+        One row of the event table per call (empty if the file is not a bat recording).
+    recorded_s : float
+        Length of the recording in seconds (0 if skipped).
+    cpu_s : float
+        CPU time spent on the file.
+    error : str or None
+        Why the file could not be read (e.g. empty or cut short by a power cut), None if it was analysed.
+    """
+    cpu_start = time.process_time()
+    try:
+        with wave.open(str(wav_file), 'rb') as wav:
+            rate, nframes = wav.getframerate(), wav.getnframes()
+        if rate < settings['min_sampling_rate']:
+            return [], 0.0, time.process_time() - cpu_start, None
+
+        detector = CallDetector(rate, settings)
+        for samples in read_chunks(wav_file, int(settings['chunk_seconds'] * rate)):
+            detector.add_chunk(samples)
+    except (wave.Error, EOFError, OSError, ValueError, KeyError) as error: # cut short mid sample, or unsupported width
+        return [], 0.0, time.process_time() - cpu_start, "{kind} {error}".format(kind=type(error).__name__, error=error).strip()
+
+    start = recording_start(wav_file)
+    events = []
+    for call in detector.finish():
+        start_time = (start + datetime.timedelta(seconds=call['start_s'])).isoformat(timespec='milliseconds') if start else ''
+        events.append(dict(call, file=wav_file.name, start_time=start_time))
+    return events, nframes / rate, time.process_time() - cpu_start, None
+
+
+def detect_night(wav_files, settings, workers=None):
+    """
+    Find the calls in all recordings of a night using a process pool.
+
+    Parameters
+    ----------
+    wav_files : list of pathlib.Path
+        Recordings to analyse.
+    settings : dict
+        Detector settings, see DEFAULT_SETTINGS.
+    workers : int, optional
+        Number of processes. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    events : list of dict
+        All calls, sorted by file and start time.
+    recorded_s : float
+        Total length of the bat recordings analysed, in seconds.
+    cpu_s : float
+        Total CPU time spent by the workers, in seconds.
+    skipped : list of tuple
+        (file name, error) for each recording that could not be read. The rest of the night is still analysed.
+    """
+    events, recorded_s, cpu_s, skipped = [], 0.0, 0.0, []
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        results = pool.map(detect_file, wav_files, [settings] * len(wav_files))
+        for wav_file, (file_events, file_recorded_s, file_cpu_s, error) in zip(wav_files, results):
+            events.extend(file_events)
+            recorded_s += file_recorded_s
+            cpu_s += file_cpu_s
+            if error is not None:
+                skipped.append((wav_file.name, error))
+    events.sort(key=lambda event: (event['file'], event['start_s']))
+    return events, recorded_s, cpu_s, skipped
+
+
+def write_events(events, events_file):
+    """Write the event table as a CSV file."""
+    tmp_file = Path(str(events_file) + '.tmp')
+    with tmp_file.open('w', newline='') as fp:
+        writer = csv.DictWriter(fp, fieldnames=EVENT_COLUMNS)
+        writer.writeheader()
+        writer.writerows(events)
+    os.replace(tmp_file, events_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--date', help='night to analyse as year_month_day e.g. 2023_2_8 (default: yesterday)')
+    parser.add_argument('--config', default=CONFIG_FILE, help='path to system_config.JSON')
+    parser.add_argument('--workers', type=int, help='number of processes (default: number of CPUs)')
+    args = parser.parse_args()
+
+    with open(args.config) as fp:
+        config = json.load(fp)
+    settings = dict(DEFAULT_SETTINGS, **config['bats'].get('detector', {}))
+
+    if args.date is None:
+        yesterday = datetime.date.today() - datetime.timedelta(days=1)
+        args.date = "%s_%s_%s" % (yesterday.year, yesterday.month, yesterday.day)
+
+    # batRecording.py saves to the same place as the bird recordings, e.g. /media/bird-pi/PiImages/BIRD/raw_audio/2023_2_8
+    raw_audio = Path(config['birds']['directory_to_save_audio'])
+    wav_files = sorted((raw_audio / args.date).glob('*.wav'))
+    events_dir = Path(settings.get('directory_to_save_events', raw_audio.parent / 'bat_events'))
+    events_dir.mkdir(parents=True, exist_ok=True)
+
+    wall_start = time.monotonic()
+    events, recorded_s, cpu_s, skipped = detect_night(wav_files, settings, args.workers)
+    events_file = events_dir / (args.date + '.csv')
+    write_events(events, events_file)
+
+    for name, error in skipped:
+        print("Skipped {name} > {error}".format(name=name, error=error))
+    print("Found {calls} bat calls in {hours:.2f} hours of recordings > {events_file}".format(calls=len(events), hours=recorded_s / 3600, events_file=events_file))
+    if cpu_s > 0:
+        print("Throughput: {rate:.1f} recorded hours per CPU-hour ({wall:.1f}s wall time)".format(rate=recorded_s / cpu_s, wall=time.monotonic() - wall_start))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
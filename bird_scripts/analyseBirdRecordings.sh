@@ -14,8 +14,8 @@ yesterday=$(date -d "1 day ago" '+%Y_%-m_%-d')
 # make a new directory (named according to yesterday's date) 
 sudo mkdir /media/bird-pi/PiImages/BIRD/analysed_audio/$yesterday # e.g. /media/bird-pi/PiImages/BIRD/analysed_audio/2023_04_04
 
-# Run analyze.py from birdnet 
-sudo python3 /home/bird-pi/BirdNET-Analyzer/analyze.py --i /media/bird-pi/PiImages/BIRD/raw_audio/$yesterday/ --o /media/bird-pi/PiImages/BIRD/analysed_audio/$yesterday/ --lat $lat --lon $lon --rtype 'r'
+# Run analyze.py from birdnet (through the supervisor so it runs at low priority and is paused while audio is being captured)
+sudo python3 /home/bird-pi/ami_setup/supervisor_scripts/superviseWorkload.py analysis -- --i /media/bird-pi/PiImages/BIRD/raw_audio/$yesterday/ --o /media/bird-pi/PiImages/BIRD/analysed_audio/$yesterday/ --lat $lat --lon $lon --rtype 'r'
 
 # ===========================================================================================================================
 
@@ -11,8 +11,10 @@ __author__ = 'Grace Skinner'
 from pathlib import Path # pathlib part of python standard library. Used to make new directories
 import datetime # datetime part of python standard library. Used to get date and time 
 import subprocess # Used to run bash arecord from python
+import sys # Used to exit early if the adaptive schedule says not to record, or with an error if arecord hangs
 #import birdconfig # Used to configure settings for bird recording. Access variables defined in birdconfig.py
 import json # Used to configure settings for bird recording. Access variables defined in system_config.JSON
+import wave # Used to catch errors reading back a recording that was cut short
 
 
 # ===========================================================================================================================
@@ -26,6 +28,30 @@ with open('/home/bird-pi/ami_setup/system_config.JSON') as system_config_file:
 
 # ===========================================================================================================================
 
+### Adaptive schedule ###
+
+# If the adaptive schedule is switched on, cron only runs this script when adaptive_schedule.py --check says a recording is
+# due. The planner (crontab_scripts/adaptive_schedule.py) decides again under the state file lock, based on recent activity
+# and the day's budget, so overlapping runs can't both record
+adaptive = system_variables['birds'].get('adaptive', {}).get('enabled') == "yes"
+if adaptive:
+	sys.path.append(str(Path(__file__).resolve().parent.parent / 'crontab_scripts'))
+	import adaptive_schedule
+
+	adaptive_variables = adaptive_schedule.adaptive_settings(system_variables)
+	record_now = False
+	with adaptive_schedule.locked_state(adaptive_variables['state_file']) as adaptive_state:
+		if adaptive_state['state'] is not None: # no plan until determine_times_birdpi.py has run
+			planner = adaptive_schedule.AdaptivePlanner(adaptive_state['state'], adaptive_variables, float(system_variables['birds']['duration']), adaptive_schedule.clip_bytes(system_variables))
+			record_now = planner.should_record(datetime.datetime.now())
+			if record_now:
+				planner.add_clip(datetime.datetime.now()) # take it out of the budget straight away so overlapping runs can't both record
+	if not record_now:
+		print("Adaptive schedule > not recording this time")
+		sys.exit(0)
+
+# ===========================================================================================================================
+
 ### Set up directory and file name/path ###
 
 ## Make directory to store files based on date
@@ -82,10 +108,41 @@ print("Start recording with arecord > rec_proc pid = " + str(rec_proc.pid))
 print("Start recording with arecord > recording started")
 
 # Make sure it waits for the recording to be complete before moving on
-rec_proc.wait()
+# Don't wait forever - if arecord hangs (e.g. the mic has been unplugged) stop it so the next recording can start
+try:
+	rec_proc.wait(timeout=int(system_variables['birds']['duration']) + 60)
+except subprocess.TimeoutExpired:
+	rec_proc.kill()
+	rec_proc.wait()
+	print("Stop recording with arecord > arecord did not finish in time and was killed")
+
+# Check arecord worked and wrote more than a WAV header
+recorded = rec_proc.returncode == 0 and Path(full_path).is_file() and Path(full_path).stat().st_size > 44
 
 # Final verbose
-print("Stop recording with arecord > Recording stopped") 
+if recorded:
+	print("Stop recording with arecord > Recording stopped") 
+else:
+	print("Stop recording with arecord > Recording failed (arecord exit code " + str(rec_proc.returncode) + ")")
+
+# Tell the adaptive schedule whether anything was going on in this clip, or give back the budget if there is no clip
+if adaptive:
+	active = False
+	if recorded:
+		try:
+			active = adaptive_schedule.clip_activity(full_path) >= adaptive_variables['activity_db']
+		except (wave.Error, EOFError, OSError, ValueError): # cut short e.g. by the mic being unplugged
+			recorded = False
+	with adaptive_schedule.locked_state(adaptive_variables['state_file']) as adaptive_state:
+		planner = adaptive_schedule.AdaptivePlanner(adaptive_state['state'], adaptive_variables, float(system_variables['birds']['duration']), adaptive_schedule.clip_bytes(system_variables))
+		if recorded:
+			planner.add_activity(active)
+		else:
+			planner.refund_clip()
+	print("Adaptive schedule > " + (("clip was " + ("active" if active else "quiet")) if recorded else "no clip, budget given back"))
+
+if not recorded:
+	sys.exit(1)
 
 # ===========================================================================================================================
 
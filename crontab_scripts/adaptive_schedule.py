@@ -0,0 +1,485 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+
+"""
+Adaptive duty cycle for the bird recordings.
+
+With birds.adaptive.enabled set to "yes", determine_times_birdpi.py writes the day's recording windows (from
+calculate_birds_time) to the adaptive state file and schedules birdRecording.py every birds.adaptive.min_interval minutes.
+Each cron run first asks this file (--check) whether to record, so runs that skip only start one small Python process
+instead of the supervisor and birdRecording.py. birdRecording.py then asks should_record() again under the state file lock
+and takes the clip out of the budget: recordings are closer together when the last few clips were active (loud sounds
+above the background) and further apart when they were quiet, while making sure the day's budget of recording seconds
+and bytes lasts until the end of the last window.
+
+Run this file with --replay to compare the adaptive schedule with the fixed birds.interval schedule on archived nights.
+"""
+
+import argparse
+import datetime
+import fcntl
+import json
+import sys
+import wave
+from contextlib import contextmanager
+from pathlib import Path
+
+
+CONFIG_FILE = '/home/bird-pi/ami_setup/system_config.JSON'
+
+DEFAULT_SETTINGS = {
+    'min_interval': 1,       # minutes, also how often cron runs birdRecording.py
+    'max_interval': 15,      # minutes between recordings when nothing is happening
+    'budget_seconds': 1800,  # seconds of audio per day
+    'budget_mb': 500,        # MB of audio per day
+    'burst': 1.0,            # how much faster than an even spread of the budget to record when clips are active
+    'activity_db': 12,       # clip counts as active if its loud frames are this much above its quiet ones
+    'smoothing': 0.5,        # weight of the latest clip in the activity level
+    'day_start': '12:00',    # the budget runs from this time of day to the same time the next day, must be outside the windows
+}
+
+# Bytes each sample takes in the WAV file arecord writes for each -f format (S24_LE is 24 bits stored in 4 bytes)
+SAMPLE_BYTES = {
+    'S8': 1, 'U8': 1, 'MU_LAW': 1, 'A_LAW': 1,
+    'S16_LE': 2, 'S16_BE': 2, 'U16_LE': 2, 'U16_BE': 2,
+    'S24_LE': 4, 'S24_BE': 4, 'U24_LE': 4, 'U24_BE': 4,
+    'S24_3LE': 3, 'S24_3BE': 3, 'U24_3LE': 3, 'U24_3BE': 3,
+    'S32_LE': 4, 'S32_BE': 4, 'U32_LE': 4, 'U32_BE': 4,
+    'FLOAT_LE': 4, 'FLOAT_BE': 4, 'FLOAT64_LE': 8, 'FLOAT64_BE': 8,
+}
+
+
+def adaptive_settings(config):
+    """Returns birds.adaptive from system_config.JSON with the defaults filled in."""
+    return dict(DEFAULT_SETTINGS, **config['birds'].get('adaptive', {}))
+
+
+def clip_bytes(config):
+    """Returns the size in bytes of one recording made with the birds settings (WAV header included)."""
+    birds = config['birds']
+    if birds['data_format'] not in SAMPLE_BYTES:
+        raise ValueError("Unknown birds.data_format {data_format}, expected one of {formats}".format(
+            data_format=birds['data_format'], formats=', '.join(SAMPLE_BYTES)))
+    sample_bytes = SAMPLE_BYTES[birds['data_format']]
+    return int(birds['duration']) * int(birds['sampling_rate']) * int(birds['number_of_channels']) * sample_bytes + 44
+
+# ===========================================================================================================================
+
+### Activity ###
+
+def clip_activity(wav_file, frame_seconds=0.05):
+    """
+    Cheap measure of how much is going on in a recording: the level of its loud frames above its quiet frames.
+
+    Parameters
+    ----------
+    wav_file : str or pathlib.Path
+        Recording to measure (PCM WAV, first channel used).
+    frame_seconds : float
+        Length of the frames the level is measured over.
+
+    Returns
+    -------
+    float
+        90th percentile minus 10th percentile frame level in dB. Steady background noise scores low, calls and song high.
+    """
+    import numpy as np # only needed here, keeps --check (run by cron every min_interval) quick to start
+
+    with wave.open(str(wav_file), 'rb') as wav:
+        width, channels, rate = wav.getsampwidth(), wav.getnchannels(), wav.getframerate()
+        raw = wav.readframes(wav.getnframes())
+    if width == 3: # no numpy 24 bit type, put each sample in the top 3 bytes of a 32 bit one
+        raw = np.pad(np.frombuffer(raw, np.uint8).reshape(-1, 3), ((0, 0), (1, 0))).tobytes()
+    dtype = {1: np.uint8, 2: '<i2', 3: '<i4', 4: '<i4'}[width]
+    samples = np.frombuffer(raw, dtype)[::channels].astype(np.float32)
+
+    samples = np.diff(samples) # first difference takes out wind rumble and DC offset
+    frame = max(int(frame_seconds * rate), 1)
+    count = len(samples) // frame
+    if count < 2:
+        return 0.0
+    level_db = 10 * np.log10((samples[:count * frame].reshape(count, frame) ** 2).mean(axis=1) + 1e-12)
+    return float(np.percentile(level_db, 90) - np.percentile(level_db, 10))
+
+# ===========================================================================================================================
+
+### Planning ###
+
+class AdaptivePlanner:
+    """
+    Decides when to record within the day's windows.
+
+    Parameters
+    ----------
+    state : dict
+        'windows' (list of [start, end] times of day as 'HH:MM'), 'date' of the recording day the budget is for,
+        'used_seconds', 'used_bytes', 'last_record' (ISO time or None) and 'activity' (0 quiet - 1 active). Updated in place.
+    settings : dict
+        birds.adaptive settings, see DEFAULT_SETTINGS. The recording day runs from day_start to day_start the next day,
+        so an evening window and the next morning's window share one budget, which is never reset part way through.
+    duration : float
+        Length of one recording in seconds.
+    size : int
+        Size of one recording in bytes.
+    """
+
+    def __init__(self, state, settings, duration, size):
+        self.state, self.settings = state, settings
+        self.duration, self.size = duration, size
+        self.times = [(datetime.time.fromisoformat(start), datetime.time.fromisoformat(end)) for start, end in state['windows']]
+
+    def windows(self, now):
+        """Returns the windows of now's recording day as (start, end) datetimes. Windows can run past midnight."""
+        day = recording_day(now, self.settings)
+        day_start = datetime.time.fromisoformat(self.settings['day_start'])
+        windows = []
+        for start_time, end_time in self.times:
+            start = datetime.datetime.combine(day, start_time)
+            if start_time < day_start: # e.g. the sunrise window is on the morning after the day starts
+                start += datetime.timedelta(days=1)
+            end = datetime.datetime.combine(start.date(), end_time)
+            if end <= start:
+                end += datetime.timedelta(days=1)
+            windows.append((start, end))
+        return windows
+
+    def new_day(self, now):
+        """Reset the budget if this is the first call of a new recording day (the plan itself carries over)."""
+        day = recording_day(now, self.settings).isoformat()
+        if self.state['date'] != day:
+            self.state.update(date=day, used_seconds=0.0, used_bytes=0)
+
+    def in_window(self, now):
+        return any(start <= now <= end for start, end in self.windows(now))
+
+    def clips_left(self):
+        """Number of recordings left in the day's budget."""
+        seconds = (self.settings['budget_seconds'] - self.state['used_seconds']) / self.duration
+        size = (self.settings['budget_mb'] * 1e6 - self.state['used_bytes']) / self.size
+        return max(min(seconds, size), 0)
+
+    def interval(self, now):
+        """
+        Returns the time to leave between recordings (seconds) at this moment.
+
+        Quiet clips push it towards max_interval and active ones towards min_interval, but it never drops below the interval
+        that would spread the rest of the budget evenly over the rest of the windows by more than a factor of (1 + burst).
+        """
+        activity = self.state['activity']
+        min_s, max_s = self.settings['min_interval'] * 60, self.settings['max_interval'] * 60
+        wanted = max_s - activity * (max_s - min_s)
+
+        window_left = sum((end - max(start, now)).total_seconds() for start, end in self.windows(now) if end > now)
+        clips_left = self.clips_left()
+        if clips_left < 1:
+            return float('inf')
+        even = window_left / clips_left
+        return max(wanted, even / (1 + self.settings['burst'] * activity), min_s)
+
+    def should_record(self, now):
+        """True if a recording should be made now."""
+        self.new_day(now)
+        if not self.in_window(now) or self.clips_left() < 1:
+            return False
+        if self.state['last_record'] is None:
+            return True
+        since = (now - datetime.datetime.fromisoformat(self.state['last_record'])).total_seconds()
+        # cron only runs every min_interval, so round to the nearest run rather than waiting a whole extra one
+        return since >= self.interval(now) - self.settings['min_interval'] * 30
+
+    def add_clip(self, now):
+        """Take a recording made now out of the budget."""
+        self.new_day(now)
+        self.state['last_record'] = now.isoformat()
+        self.state['used_seconds'] += self.duration
+        self.state['used_bytes'] += self.size
+
+    def refund_clip(self):
+        """Give back the budget of a recording that failed (arecord error or empty file)."""
+        self.state['used_seconds'] = max(self.state['used_seconds'] - self.duration, 0.0)
+        self.state['used_bytes'] = max(self.state['used_bytes'] - self.size, 0)
+
+    def add_activity(self, active):
+        """Update the activity level with whether the latest clip was active."""
+        weight = self.settings['smoothing']
+        self.state['activity'] = (1 - weight) * self.state['activity'] + weight * float(active)
+
+
+def recording_day(now, settings):
+    """Returns the date of the recording day now is in: the day started at day_start on that date."""
+    day_start = datetime.time.fromisoformat(settings['day_start'])
+    return (now - datetime.timedelta(hours=day_start.hour, minutes=day_start.minute)).date()
+
+
+def new_state(windows, day):
+    """
+    Returns a fresh state for the recording day.
+
+    Parameters
+    ----------
+    windows : list of tuple
+        (start, end) datetimes of the recording windows, as worked out by calculate_birds_time. Only the time of day is
+        kept, so the plan carries on working on the following days if determine_times_birdpi.py isn't run again.
+    day : datetime.date
+        Recording day the budget starts with, see recording_day.
+
+    Returns
+    -------
+    dict
+        State for AdaptivePlanner.
+    """
+    return {'date': day.isoformat(), 'windows': [[start.strftime('%H:%M'), end.strftime('%H:%M')] for start, end in windows],
+            'used_seconds': 0.0, 'used_bytes': 0, 'last_record': None, 'activity': 0.0}
+
+
+@contextmanager
+def locked_state(state_file):
+    """Open the state file for reading and updating, locked so overlapping cron runs don't both record."""
+    path = Path(state_file)
+    path.touch(exist_ok=True)
+    with path.open('r+') as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        text = fp.read()
+        box = {'state': json.loads(text) if text else None}
+        yield box
+        if box['state'] is not None and json.dumps(box['state'], indent=3) != text:
+            fp.seek(0)
+            fp.truncate()
+            json.dump(box['state'], fp, indent=3)
+
+
+def write_plan(state_file, windows, settings):
+    """
+    Set the day's windows (called by determine_times_birdpi.py). Budget already used in the current recording day is kept,
+    e.g. after a reboot.
+    """
+    day = recording_day(datetime.datetime.now(), settings)
+    with locked_state(state_file) as box:
+        if box['state'] is not None and box['state']['date'] == day.isoformat():
+            box['state']['windows'] = new_state(windows, day)['windows']
+        else:
+            box['state'] = new_state(windows, day)
+
+# ===========================================================================================================================
+
+### Replay ###
+
+def night_clips(raw_audio_dir, analysed_audio_dir, sampling_rate):
+    """
+    Returns the archived bird clips of a night with their activity, for replay.
+
+    Parameters
+    ----------
+    raw_audio_dir : pathlib.Path
+        e.g. raw_audio/2023_5_31.
+    analysed_audio_dir : pathlib.Path
+        e.g. analysed_audio/2023_5_31. BirdNET detections are counted per clip if there are results here.
+    sampling_rate : int
+        birds.sampling_rate. Other files in the directory (e.g. bat recordings, saved in the same place) are left out.
+
+    Returns
+    -------
+    clips : list of dict
+        'time', 'activity' (dB, see clip_activity) and 'detections' (None if there are no BirdNET results) for each clip.
+    skipped : list of tuple
+        (file name, error) for each recording that could not be read.
+    """
+    detections = {}
+    for results_file in analysed_audio_dir.glob('*.csv') if analysed_audio_dir.is_dir() else []:
+        for line in results_file.read_text().splitlines()[1:]:
+            name = Path(line.split(',')[0]).name
+            detections[name] = detections.get(name, 0) + 1
+    have_results = analysed_audio_dir.is_dir() and any(analysed_audio_dir.glob('*.csv'))
+
+    clips, skipped = [], []
+    for wav_file in sorted(raw_audio_dir.glob('*.wav')):
+        parts = wav_file.stem.split('__')
+        try:
+            time = datetime.datetime(*map(int, (parts[-2] + '_' + parts[-1]).split('_')))
+        except (IndexError, ValueError):
+            continue
+        try:
+            with wave.open(str(wav_file), 'rb') as wav:
+                if wav.getframerate() != int(sampling_rate):
+                    continue
+            activity = clip_activity(wav_file)
+        except (wave.Error, EOFError, OSError, ValueError, KeyError) as error: # empty, cut short or unsupported width
+            skipped.append((wav_file.name, "{kind} {error}".format(kind=type(error).__name__, error=error).strip()))
+            continue
+        clips.append({'time': time, 'activity': activity,
+                      'detections': detections.get(wav_file.name, 0) if have_results else None})
+    clips.sort(key=lambda clip: clip['time'])
+    return clips, skipped
+
+
+def fixed_times(start, end, interval):
+    """
+    Returns the times the fixed schedule records at in a window, worked out the same way as the cron jobs made by
+    update_crontab_birds: from the start minute every interval minutes, carrying the offset over into the next hour.
+
+    Parameters
+    ----------
+    start, end : datetime
+        Recording window, as worked out by calculate_birds_time.
+    interval : int
+        birds.interval, minutes between recordings.
+
+    Returns
+    -------
+    set of datetime
+        Times (to the minute) cron runs birdRecording.py at.
+    """
+    if end <= start:
+        end += datetime.timedelta(days=1)
+    hour = start.replace(minute=0, second=0, microsecond=0)
+    last_hour = end.replace(minute=0, second=0, microsecond=0)
+    times = set()
+    if start.minute == 0 and end.minute == 0: # one job for the whole window, every hour restarts on the hour
+        while hour <= last_hour:
+            times.update(hour + datetime.timedelta(minutes=minute) for minute in range(0, 60, interval))
+            hour += datetime.timedelta(hours=1)
+        return times
+
+    first_minute = start.minute # first minute in the hour to record at
+    while hour <= last_hour:
+        if hour == last_hour and end.minute == 0:
+            break
+        last_minute = end.minute if hour == last_hour else 59
+        times.update(hour + datetime.timedelta(minutes=minute) for minute in range(first_minute, last_minute + 1, interval))
+        mins_diff = 60 - first_minute
+        first_minute = 0 if mins_diff % interval == 0 else interval - (mins_diff % interval)
+        hour += datetime.timedelta(hours=1)
+    return times
+
+
+def replay(clips, windows, settings, interval, duration, size):
+    """
+    Replay the adaptive and fixed schedules over the archived clips of a night.
+
+    Each archived clip stands for one moment the schedule could have recorded at, so the archive should be recorded more
+    densely (e.g. every minute) than either schedule. A clip is worth catching if it has BirdNET detections, or if there
+    are no BirdNET results, if it is active.
+
+    Parameters
+    ----------
+    clips : list of dict
+        As returned by night_clips.
+    windows : list of tuple
+        (start, end) datetimes of the night's windows.
+    settings : dict
+        birds.adaptive settings.
+    interval : int
+        birds.interval, minutes between recordings of the fixed schedule.
+    duration : float
+        Length of one recording in seconds.
+    size : int
+        Size of one recording in bytes.
+
+    Returns
+    -------
+    dict
+        For 'fixed' and 'adaptive': 'clips' recorded, 'seconds' used, 'caught' worthwhile clips, 'detections' caught and
+        'coverage' (fraction of the worthwhile clips caught). Plus 'worthwhile' and 'total_detections' for the night.
+        Detection counts are None if the night has no BirdNET results.
+    """
+    def worthwhile(clip):
+        if clip['detections'] is not None:
+            return clip['detections'] > 0
+        return clip['activity'] >= settings['activity_db']
+
+    day = recording_day(clips[0]['time'], settings) if clips else datetime.date.today()
+    planner = AdaptivePlanner(new_state(windows, day), settings, duration, size)
+    fixed = AdaptivePlanner(new_state(windows, day), settings, duration, size)
+    fixed_schedule = set().union(*(fixed_times(start, end, interval) for start, end in windows))
+
+    chosen = {'fixed': [], 'adaptive': []}
+    for clip in clips:
+        now = clip['time']
+        if planner.should_record(now):
+            planner.add_clip(now)
+            planner.add_activity(clip['activity'] >= settings['activity_db'])
+            chosen['adaptive'].append(clip)
+        # fixed schedule: the cron jobs made by update_crontab_birds, until the budget runs out
+        fixed.new_day(now)
+        if now.replace(second=0, microsecond=0) in fixed_schedule and fixed.clips_left() >= 1:
+            fixed.add_clip(now)
+            chosen['fixed'].append(clip)
+
+    total = sum(worthwhile(clip) for clip in clips)
+    have_results = any(clip['detections'] is not None for clip in clips)
+    results = {'worthwhile': total, 'total_detections': sum(clip['detections'] or 0 for clip in clips) if have_results else None}
+    for name, picked in chosen.items():
+        caught = sum(worthwhile(clip) for clip in picked)
+        results[name] = {'clips': len(picked), 'seconds': len(picked) * duration, 'caught': caught,
+                         'detections': sum(clip['detections'] or 0 for clip in picked) if have_results else None,
+                         'coverage': caught / total if total else 0.0}
+    return results
+
+
+def replay_windows(config, night):
+    """Work out a past night's windows the same way determine_times_birdpi.py does."""
+    from functions import calculate_birds_time
+    from suntime import Sun
+
+    sun = Sun(config['location']['lat'], config['location']['lon'])
+    sunrise, sunset = sun.get_local_sunrise_time(night), sun.get_local_sunset_time(night)
+    sunrise, sunset = sunrise.replace(tzinfo=None), sunset.replace(tzinfo=None)
+    windows = []
+    if config['birds']['sunrise']['record'] == 'yes':
+        windows.append(calculate_birds_time(sunrise, config['birds']['sunrise']['start'], config['birds']['sunrise']['end']))
+    if config['birds']['sunset']['record'] == 'yes':
+        windows.append(calculate_birds_time(sunset, config['birds']['sunset']['start'], config['birds']['sunset']['end']))
+    return windows
+
+
+def check(config):
+    """
+    Returns True if birdRecording.py should be started now. Nothing is taken out of the budget, birdRecording.py asks
+    again under the lock before recording.
+    """
+    settings = adaptive_settings(config)
+    if settings.get('enabled') != "yes":
+        return True
+    with locked_state(settings['state_file']) as box:
+        if box['state'] is None: # no plan until determine_times_birdpi.py has run
+            return False
+        planner = AdaptivePlanner(box['state'], settings, float(config['birds']['duration']), clip_bytes(config))
+        return planner.should_record(datetime.datetime.now())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check whether to record now, or compare the adaptive and fixed bird schedules on archived nights')
+    action = parser.add_mutually_exclusive_group(required=True)
+    action.add_argument('--check', action='store_true', help='exit with 0 if a recording should be made now, 1 if not (used by cron)')
+    action.add_argument('--replay', nargs='+', metavar='DATE', help='archived nights as year_month_day e.g. 2023_5_31')
+    parser.add_argument('--config', default=CONFIG_FILE, help='path to system_config.JSON')
+    args = parser.parse_args()
+
+    with open(args.config) as fp:
+        config = json.load(fp)
+    if args.check:
+        return 0 if check(config) else 1
+
+    settings = adaptive_settings(config)
+    duration, size = float(config['birds']['duration']), clip_bytes(config)
+    raw_audio = Path(config['birds']['directory_to_save_audio'])
+
+    print("{night:<12} {kind:<9} {clips:>6} {seconds:>8} {caught:>11} {detections:>11} {coverage:>9}".format(
+        night='night', kind='schedule', clips='clips', seconds='seconds', caught='caught', detections='detections', coverage='coverage'))
+    for night_dir in args.replay:
+        night = datetime.datetime.strptime(night_dir, '%Y_%m_%d').date()
+        clips, skipped = night_clips(raw_audio / night_dir, raw_audio.parent / 'analysed_audio' / night_dir, config['birds']['sampling_rate'])
+        for name, error in skipped:
+            print("{night:<12} skipped {name} > {error}".format(night=night_dir, name=name, error=error))
+        results = replay(clips, replay_windows(config, night), settings, config['birds']['interval'], duration, size)
+        for kind in ('fixed', 'adaptive'):
+            result = results[kind]
+            detections = '-' if result['detections'] is None else "{caught}/{total}".format(caught=result['detections'], total=results['total_detections'])
+            print("{night:<12} {kind:<9} {clips:>6} {seconds:>8.0f} {caught:>5}/{total:<5} {detections:>11} {coverage:>8.0%}".format(
+                night=night_dir, kind=kind, clips=result['clips'], seconds=result['seconds'], caught=result['caught'],
+                total=results['worthwhile'], detections=detections, coverage=result['coverage']))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,6 +4,7 @@
 from crontab import CronTab
 from functions import *
 from datetime import datetime
+import adaptive_schedule
 
 
 def main():
@@ -69,6 +70,20 @@ def main():
 
 
 
+	# Adaptive schedule - cron checks every min_interval minutes whether to record (adaptive_schedule.py --check), starting from today's windows
+	interval = config["birds"]['interval']
+	adaptive = config["birds"].get('adaptive', {}).get('enabled') == "yes"
+	if adaptive:
+		adaptive_variables = adaptive_schedule.adaptive_settings(config)
+		interval = adaptive_variables['min_interval']
+		windows = []
+		if config["birds"]['sunrise']['record'] == "yes":
+			windows.append((start_sunrise, end_sunrise))
+		if config["birds"]['sunset']['record'] == "yes":
+			windows.append((start_sunset, end_sunset))
+		adaptive_schedule.write_plan(adaptive_variables['state_file'], windows, adaptive_variables)
+
+
 	# Update contrab jobs                                                                                                                                                                          
 	ami_cron = CronTab(user='bird-pi') 
 	
@@ -87,8 +102,9 @@ def main():
 		ami_cron = update_crontab_birds(ami_cron, 
 										start_sunrise, 
 										end_sunrise, 
-										config["birds"]['interval'], 
-										'morning')
+										interval, 
+										'morning', 
+										adaptive)
 	else:
 		delete_job_birds(ami_cron, "morning") # delete all morning jobs
 	
@@ -97,8 +113,9 @@ def main():
 		ami_cron = update_crontab_birds(ami_cron, 
 										start_sunset, 
 										end_sunset, 
-										config["birds"]['interval'], 
-										'evening')
+										interval, 
+										'evening', 
+										adaptive)
 	else:
 		delete_job_birds(ami_cron, "evening") # delete all evening jobs 
 
@@ -214,7 +214,7 @@ def schedule_cron_job_no_interval(job, start_minute, end_minute, start_hour, end
     return job_schedule
 
 
-def update_crontab_birds(ami_cron, start_time, end_time, interval, day_time):
+def update_crontab_birds(ami_cron, start_time, end_time, interval, day_time, adaptive=False):
     """
     Update the crontab schedule for the birds. 
 
@@ -230,6 +230,8 @@ def update_crontab_birds(ami_cron, start_time, end_time, interval, day_time):
         Every how many minutes to record sound.
     day_time : str
         Which time of the day, valid options 'morning' and 'evening'.
+    adaptive : bool, optional
+        If the adaptive schedule is on, only start the recording when adaptive_schedule.py --check says so.
 
     Returns
     -------
@@ -242,7 +244,9 @@ def update_crontab_birds(ami_cron, start_time, end_time, interval, day_time):
             ami_cron.remove(job)
     
     comment = 'birds {day_time} {num}'.format(day_time=day_time, num=1)
-    command = 'python3 /home/bird-pi/ami_setup/bird_scripts/birdRecording.py'
+    command = 'python3 /home/bird-pi/ami_setup/supervisor_scripts/superviseWorkload.py capture' # runs birdRecording.py with capture priority
+    if adaptive: # cron runs every minute, only start the supervisor and birdRecording.py when a recording is due
+        command = 'python3 /home/bird-pi/ami_setup/crontab_scripts/adaptive_schedule.py --check && ' + command
     
     # calculate number of recording hours
     if start_time.hour < end_time.hour: # e.g. 02:00-04:00 or 21:00-23:00
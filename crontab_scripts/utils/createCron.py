@@ -7,7 +7,7 @@ ami_cron = CronTab(user='crontab')
 timer_job = ami_cron.new(command='python3 /home/pi/scripts/determine_times.py ', comment='timer')
 timer_job.every_reboot()
 
-motion_on_job = ami_cron.new(command='sudo motion', comment='motion on')
+motion_on_job = ami_cron.new(command='sudo python3 /home/pi/scripts/superviseWorkload.py motion --config /home/pi/Documents/system_config.JSON', comment='motion on')
 motion_on_job.hour.on(21)
 
 motion_off_job = ami_cron.new(command='sudo pkill motion', comment='motion off')
@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+
+"""Apply the camera control profiles in camera_profiles.JSON to every camera used by motion (replaces the v4l2-ctl calls in setCamera.sh)"""
+# Each camera is opened once and all of its controls are written with a single VIDIOC_S_EXT_CTRLS ioctl, then read back
+# with a single VIDIOC_G_EXT_CTRLS ioctl to check they stuck. All cameras are configured at the same time (one thread each).
+# Controls whose value has not changed since the last run (and the camera has not been re-plugged) are not written again.
+
+import argparse
+import ctypes
+import errno
+import fcntl
+import json
+import os
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+
+PROFILES_FILE = Path(__file__).resolve().parent / 'camera_profiles.JSON'
+
+# Newer uvcvideo drivers renamed some of the controls used in setCamera.sh. Map old name -> new name so the same
+# profile works on both.
+CONTROL_ALIASES = {
+    'focus_auto': 'focus_automatic_continuous',
+    'exposure_auto': 'auto_exposure',
+    'exposure_absolute': 'exposure_time_absolute',
+    'white_balance_temperature_auto': 'white_balance_automatic',
+}
+
+# ===========================================================================================================================
+
+### V4L2 ioctl definitions (from linux/videodev2.h) ###
+
+V4L2_CTRL_FLAG_DISABLED = 0x0001
+V4L2_CTRL_FLAG_NEXT_CTRL = 0x80000000
+V4L2_CTRL_TYPE_CTRL_CLASS = 6
+V4L2_CTRL_WHICH_CUR_VAL = 0
+
+
+class v4l2_queryctrl(ctypes.Structure):
+    _fields_ = [('id', ctypes.c_uint32),
+                ('type', ctypes.c_uint32),
+                ('name', ctypes.c_char * 32),
+                ('minimum', ctypes.c_int32),
+                ('maximum', ctypes.c_int32),
+                ('step', ctypes.c_int32),
+                ('default_value', ctypes.c_int32),
+                ('flags', ctypes.c_uint32),
+                ('reserved', ctypes.c_uint32 * 2)]
+
+
+class v4l2_ext_control(ctypes.Structure):
+    _pack_ = 1
+    _fields_ = [('id', ctypes.c_uint32),
+                ('size', ctypes.c_uint32),
+                ('reserved2', ctypes.c_uint32 * 1),
+                ('value64', ctypes.c_int64)] # union with __s32 value (little endian, so value is the low 32 bits)
+
+
+class v4l2_ext_controls(ctypes.Structure):
+    _fields_ = [('which', ctypes.c_uint32),
+                ('count', ctypes.c_uint32),
+                ('error_idx', ctypes.c_uint32),
+                ('request_fd', ctypes.c_int32),
+                ('reserved', ctypes.c_uint32 * 1),
+                ('controls', ctypes.POINTER(v4l2_ext_control))]
+
+
+def _iowr(nr, struct):
+    return (3 << 30) | (ctypes.sizeof(struct) << 16) | (ord('V') << 8) | nr
+
+
+VIDIOC_QUERYCTRL = _iowr(36, v4l2_queryctrl)
+VIDIOC_G_EXT_CTRLS = _iowr(71, v4l2_ext_controls)
+VIDIOC_S_EXT_CTRLS = _iowr(72, v4l2_ext_controls)
+
+# ===========================================================================================================================
+
+### Device backends ###
+
+def control_name(raw_name):
+    """
+    Convert a V4L2 control name into the name used by v4l2-ctl e.g. 'Focus, Auto' -> 'focus_auto'.
+
+    Parameters
+    ----------
+    raw_name : str
+        Control name as reported by the driver.
+
+    Returns
+    -------
+    str
+        Lower case control name with runs of non alphanumeric characters replaced by '_'.
+    """
+    return re.sub(r'[^a-z0-9]+', '_', raw_name.lower()).strip('_')
+
+
+class V4L2Device:
+    """
+    A V4L2 video device opened once for reading and writing all of its controls.
+
+    Parameters
+    ----------
+    path : str
+        Path to the video device e.g. '/dev/v4l/by-id/usb-046d_Logitech_BRIO_E93AFC27-video-index0'.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def __enter__(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_NONBLOCK)
+        return self
+
+    def __exit__(self, *exc):
+        os.close(self.fd)
+        self.fd = None
+
+    def identity(self):
+        """Return values that change whenever the camera is re-plugged (the device node is recreated)."""
+        st = os.stat(self.path)
+        return [st.st_ino, st.st_rdev, st.st_ctime_ns]
+
+    def controls(self):
+        """Return {name: control id} for every enabled control on the device."""
+        found = {}
+        query = v4l2_queryctrl(id=V4L2_CTRL_FLAG_NEXT_CTRL)
+        while True:
+            try:
+                fcntl.ioctl(self.fd, VIDIOC_QUERYCTRL, query)
+            except OSError: # EINVAL once the last control has been returned
+                break
+            if query.type != V4L2_CTRL_TYPE_CTRL_CLASS and not query.flags & V4L2_CTRL_FLAG_DISABLED:
+                found[control_name(query.name.decode())] = query.id
+            query.id |= V4L2_CTRL_FLAG_NEXT_CTRL
+        return found
+
+    def _ext_ctrls(self, request, values):
+        array = (v4l2_ext_control * len(values))()
+        for i, (ctrl_id, value) in enumerate(values.items()):
+            array[i].id = ctrl_id
+            array[i].value64 = value
+        ctrls = v4l2_ext_controls(which=V4L2_CTRL_WHICH_CUR_VAL, count=len(values), controls=array)
+        fcntl.ioctl(self.fd, request, ctrls)
+        return {array[i].id: ctypes.c_int32(array[i].value64 & 0xffffffff).value for i in range(len(values))}
+
+    def set(self, values):
+        """Write {control id: value} to the device in one ioctl."""
+        if values:
+            self._ext_ctrls(VIDIOC_S_EXT_CTRLS, values)
+
+    def get(self, ctrl_ids):
+        """Read the current value of each control id in one ioctl."""
+        if not ctrl_ids:
+            return {}
+        return self._ext_ctrls(VIDIOC_G_EXT_CTRLS, dict.fromkeys(ctrl_ids, 0))
+
+
+class FakeDevice:
+    """
+    In-memory stand-in for V4L2Device, used for dry runs and testing without a camera attached.
+
+    Parameters
+    ----------
+    path : str
+        Path of the (pretend) video device.
+    controls : dict, optional
+        {name: value} of the controls the fake camera supports. Defaults to the BRIO controls used in setCamera.sh.
+    reject : dict, optional
+        {name: value} the fake camera refuses (EINVAL), like a driver rejecting an out of range value. A batch containing
+        one of these is refused as a whole.
+    """
+
+    BRIO_CONTROLS = ['brightness', 'contrast', 'sharpness', 'focus_auto', 'focus_absolute', 'exposure_auto',
+                     'exposure_absolute', 'zoom_absolute', 'white_balance_temperature_auto', 'white_balance_temperature']
+
+    def __init__(self, path, controls=None, reject=None):
+        self.path = path
+        names = controls if controls is not None else dict.fromkeys(self.BRIO_CONTROLS, 0)
+        self.ids = {name: 0x00980900 + i for i, name in enumerate(names)}
+        self.values = {self.ids[name]: value for name, value in names.items()}
+        self.reject = {self.ids[name]: value for name, value in (reject or {}).items()}
+        self.ioctl_calls = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def identity(self):
+        return [0, 0, 0]
+
+    def controls(self):
+        return dict(self.ids)
+
+    def set(self, values):
+        if values:
+            self.ioctl_calls += 1
+            if any(self.reject.get(ctrl_id) == value for ctrl_id, value in values.items()):
+                raise OSError(errno.EINVAL, 'Invalid argument')
+            self.values.update(values)
+
+    def get(self, ctrl_ids):
+        if not ctrl_ids:
+            return {}
+        self.ioctl_calls += 1
+        return {ctrl_id: self.values[ctrl_id] for ctrl_id in ctrl_ids}
+
+# ===========================================================================================================================
+
+### Profiles ###
+
+def read_videodevice(conf_file):
+    """
+    Returns the videodevice set in a motion camera config file.
+
+    Parameters
+    ----------
+    conf_file : pathlib.Path
+        Path to the camera config file e.g. camera1.conf.
+
+    Returns
+    -------
+    str or None
+        Path to the video device, or None if the file does not set one.
+    """
+    for line in conf_file.read_text().splitlines():
+        parts = line.split()
+        if len(parts) >= 2 and parts[0] == 'videodevice':
+            return parts[1]
+    return None
+
+
+def load_profiles(profiles_file=PROFILES_FILE):
+    """
+    Returns the profiles config and {camera name: (device path, {control: value})} for each camera.
+
+    Parameters
+    ----------
+    profiles_file : str or pathlib.Path
+        Path to camera_profiles.JSON. Camera config files are looked up in the same directory.
+
+    Returns
+    -------
+    config : dict
+        The whole profiles config.
+    cameras : dict
+        Device path and controls to apply for each camera. The per camera controls override the defaults.
+    """
+    profiles_file = Path(profiles_file)
+    with profiles_file.open() as fp:
+        config = json.load(fp)
+
+    cameras = {}
+    for name, camera in config['cameras'].items():
+        device = camera.get('device') or read_videodevice(profiles_file.parent / camera['conf'])
+        controls = dict(config.get('defaults', {}))
+        controls.update(camera.get('controls', {}))
+        cameras[name] = (device, controls)
+    return config, cameras
+
+
+def resolve_controls(available, controls):
+    """Map profile control names to device control ids, following CONTROL_ALIASES. Returns (ids, missing names)."""
+    ids, missing = {}, []
+    for name, value in controls.items():
+        ctrl_id = available.get(name, available.get(CONTROL_ALIASES.get(name)))
+        if ctrl_id is None:
+            missing.append(name)
+        else:
+            ids[name] = (ctrl_id, int(value))
+    return ids, missing
+
+# ===========================================================================================================================
+
+### Applying ###
+
+def apply_profile(device, controls, cached=None):
+    """
+    Apply a control profile to one camera and read the values back.
+
+    Parameters
+    ----------
+    device : V4L2Device or FakeDevice
+        Device to configure (not yet opened).
+    controls : dict
+        {control name: value} to apply, in the order they should be written (auto controls before absolute ones).
+    cached : dict, optional
+        State saved by the previous run for this device, {'identity': [...], 'controls': {name: value}}.
+
+    Returns
+    -------
+    dict
+        'applied', 'skipped', 'missing' and 'mismatched' control names, plus the new 'state' to cache.
+    """
+    with device:
+        identity = device.identity()
+        previous = cached['controls'] if cached and cached.get('identity') == identity else {}
+        ids, missing = resolve_controls(device.controls(), controls)
+
+        to_write = {name: ctrl for name, ctrl in ids.items() if previous.get(name) != ctrl[1]}
+        skipped = [name for name in ids if name not in to_write]
+        write_controls(device, to_write)
+
+        # Read everything back (including the skipped controls) to make sure the camera holds the profile
+        current = device.get([ctrl_id for ctrl_id, _ in ids.values()])
+        drifted = {name: ids[name] for name in skipped if current[ids[name][0]] != ids[name][1]}
+        if drifted: # camera was reset without the device node changing, write these after all
+            write_controls(device, drifted)
+            current.update(device.get([ctrl_id for ctrl_id, _ in drifted.values()]))
+            to_write.update(drifted)
+            skipped = [name for name in skipped if name not in drifted]
+
+    mismatched = {name: current[ctrl_id] for name, (ctrl_id, value) in ids.items() if current[ctrl_id] != value}
+    state = {name: value for name, (ctrl_id, value) in ids.items() if name not in mismatched}
+    return {'applied': list(to_write), 'skipped': skipped, 'missing': missing, 'mismatched': mismatched,
+            'state': {'identity': identity, 'controls': state}}
+
+
+def write_controls(device, ids):
+    """Write {name: (id, value)} in one ioctl, falling back to one control at a time if the driver rejects the batch."""
+    values = {ctrl_id: value for ctrl_id, value in ids.values()}
+    try:
+        device.set(values)
+    except OSError:
+        for ctrl_id, value in values.items():
+            try:
+                device.set({ctrl_id: value})
+            except OSError:
+                pass # reported as a mismatch when the values are read back
+
+
+def load_state(state_file):
+    try:
+        with open(state_file) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(state_file, state):
+    tmp_file = str(state_file) + '.tmp'
+    with open(tmp_file, 'w') as fp:
+        json.dump(state, fp, indent=3)
+    os.replace(tmp_file, state_file)
+
+
+def configure_cameras(cameras, state, device_factory=V4L2Device):
+    """
+    Configure all cameras concurrently.
+
+    Parameters
+    ----------
+    cameras : dict
+        {camera name: (device path, {control: value})} as returned by load_profiles.
+    state : dict
+        Cached state from the previous run, keyed by device path. Updated in place.
+    device_factory : callable
+        Builds a device from its path. V4L2Device for real cameras, FakeDevice for dry runs.
+
+    Returns
+    -------
+    dict
+        {camera name: result of apply_profile, or the exception raised while configuring it}.
+    """
+    def configure(item):
+        name, (path, controls) = item
+        if path is None:
+            return name, FileNotFoundError('no videodevice set for ' + name)
+        try:
+            return name, apply_profile(device_factory(path), controls, state.get(path))
+        except OSError as error:
+            return name, error
+
+    with ThreadPoolExecutor(max_workers=max(len(cameras), 1)) as pool:
+        results = dict(pool.map(configure, cameras.items()))
+
+    for name, result in results.items():
+        if isinstance(result, dict):
+            state[cameras[name][0]] = result['state']
+    return results
+
+
+def report(results):
+    """Print what happened to each camera. Returns the exit code: 1 if any camera could not be configured or a value didn't stick."""
+    ok = True
+    for name, result in results.items():
+        if isinstance(result, Exception):
+            print("{name}: could not configure camera > {error}".format(name=name, error=result))
+            ok = False
+            continue
+        print("{name}: applied {applied}, unchanged {skipped}".format(name=name, applied=len(result['applied']), skipped=len(result['skipped'])))
+        if result['missing']:
+            print("{name}: controls not supported by camera > {missing}".format(name=name, missing=', '.join(result['missing'])))
+        for control, value in result['mismatched'].items():
+            print("{name}: {control} did not stick (reads back {value})".format(name=name, control=control, value=value))
+            ok = False
+    return 0 if ok else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--profiles', default=str(PROFILES_FILE), help='path to camera_profiles.JSON')
+    parser.add_argument('--dry-run', action='store_true', help='use fake cameras instead of the real devices')
+    parser.add_argument('--force', action='store_true', help='ignore the cached state and write every control')
+    args = parser.parse_args()
+
+    config, cameras = load_profiles(args.profiles)
+    # Cached state is kept next to the profiles unless camera_profiles.JSON says otherwise (relative to the profiles)
+    state_file = Path(args.profiles).resolve().parent / config.get('state_file', 'camera_state.JSON')
+    state = {} if args.force or args.dry_run else load_state(state_file)
+
+    results = configure_cameras(cameras, state, FakeDevice if args.dry_run else V4L2Device)
+    exit_code = report(results)
+
+    if not args.dry_run:
+        try:
+            save_state(state_file, state)
+        except OSError as error: # cameras are configured, every control will just be written again next time
+            print("Could not save the camera state to {state_file} > {error}".format(state_file=state_file, error=error))
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
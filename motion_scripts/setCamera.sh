@@ -1,12 +1,9 @@
-v4l2-ctl -d /dev/v4l/by-id/usb-046d_Logitech_BRIO_68739DF0-video-index0 -c brightness=100
-v4l2-ctl -d /dev/v4l/by-id/usb-046d_Logitech_BRIO_68739DF0-video-index0 -c focus_auto=0
-v4l2-ctl -d /dev/v4l/by-id/usb-046d_Logitech_BRIO_68739DF0-video-index0 -c focus_absolute=50
-v4l2-ctl -d /dev/v4l/by-id/usb-046d_Logitech_BRIO_68739DF0-video-index0 -c exposure_auto=1
-v4l2-ctl -d /dev/v4l/by-id/usb-046d_Logitech_BRIO_68739DF0-video-index0 -c exposure_absolute=40
-v4l2-ctl -d /dev/v4l/by-id/usb-046d_Logitech_BRIO_68739DF0-video-index0 -c zoom_absolute=100
-v4l2-ctl -d /dev/v4l/by-id/usb-046d_Logitech_BRIO_68739DF0-video-index0 -c white_balance_temperature_auto=0
-v4l2-ctl -d /dev/v4l/by-id/usb-046d_Logitech_BRIO_68739DF0-video-index0 -c white_balance_temperature=4500
-v4l2-ctl -d /dev/v4l/by-id/usb-046d_Logitech_BRIO_68739DF0-video-index0 -c sharpness=255
-v4l2-ctl -d /dev/v4l/by-id/usb-046d_Logitech_BRIO_68739DF0-video-index0 -c contrast=20
+#!/bin/bash
 
+### Bash script to set the camera controls (brightness, focus, exposure etc.) before motion starts
 
+# The control values for each camera are in camera_profiles.JSON and the devices are read from camera1.conf - camera4.conf.
+# All cameras are configured at the same time and the values are read back to check they have been set.
+# Use --force to write every control even if it has not changed since the last run.
+
+python3 "$(dirname "$0")/cameraProfiles.py" "$@"
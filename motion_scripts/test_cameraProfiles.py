@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+
+"""Tests for cameraProfiles.py against FakeDevice (run with: python3 -m pytest motion_scripts)"""
+
+from cameraProfiles import FakeDevice, apply_profile, configure_cameras, report
+
+
+PROFILE = {'focus_auto': 0, 'focus_absolute': 0, 'exposure_auto': 3, 'brightness': 128, 'white_balance_temperature': 4000}
+
+
+def test_second_run_with_saved_state_only_reads_back():
+    device = FakeDevice('/dev/video0')
+    first = apply_profile(device, PROFILE)
+    assert sorted(first['applied']) == sorted(PROFILE)
+
+    device.ioctl_calls = 0
+    second = apply_profile(device, PROFILE, first['state'])
+    assert second['applied'] == []
+    assert sorted(second['skipped']) == sorted(PROFILE)
+    assert second['mismatched'] == {}
+    assert device.ioctl_calls == 1 # the read back, nothing written
+
+
+def test_values_changed_behind_the_cache_are_rewritten():
+    device = FakeDevice('/dev/video0')
+    state = apply_profile(device, PROFILE)['state']
+
+    device.values[device.ids['brightness']] = 50 # camera reset without being re-plugged
+    result = apply_profile(device, PROFILE, state)
+    assert result['applied'] == ['brightness']
+    assert 'brightness' not in result['skipped']
+    assert result['mismatched'] == {}
+    assert device.values[device.ids['brightness']] == 128
+
+
+def test_rejected_value_is_reported_as_mismatched():
+    devices = {}
+
+    def factory(path):
+        devices[path] = FakeDevice(path, reject={'white_balance_temperature': 4000})
+        return devices[path]
+
+    state = {}
+    results = configure_cameras({'camera1': ('/dev/video0', PROFILE)}, state, factory)
+    result = results['camera1']
+    assert result['mismatched'] == {'white_balance_temperature': 0}
+    assert devices['/dev/video0'].values[devices['/dev/video0'].ids['brightness']] == 128 # rest written one at a time
+    assert 'white_balance_temperature' not in state['/dev/video0']['controls'] # retried on the next run
+    assert report(results) == 1
+
+
+def test_report_ok():
+    results = configure_cameras({'camera1': ('/dev/video0', PROFILE)}, {}, FakeDevice)
+    assert report(results) == 0
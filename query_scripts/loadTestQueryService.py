@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+
+"""Load test for queryService.py: several clients at once listing recordings, seeking in audio and fetching renders"""
+# e.g. python3 loadTestQueryService.py http://station.local:8090 --clients 8 --seconds 30 --start 2023-02-08T00:00
+# Prints the request rate and latency percentiles for each kind of request.
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+from urllib.error import URLError
+
+
+def fetch(url, headers=None):
+    request = urllib.request.Request(url, headers=headers or {})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return response.status, response.read()
+
+
+def client(base_url, recordings, query, deadline, results, lock, rng, cold_renders):
+    """
+    One client making requests until the deadline: listings, a random audio range, a thumbnail or a full size render.
+    Thumbnails are always the same size so repeats come from the render cache, full size renders are a random size when
+    cold_renders is set so nearly every one has to be rendered (and waits for a render slot).
+
+    Parameters
+    ----------
+    base_url : str
+        Where the service is running.
+    recordings : list of dict
+        Recordings returned by /recordings, to pick audio and renders from.
+    query : str
+        Query string for the listing requests.
+    deadline : float
+        time.monotonic() value to stop at.
+    results : dict
+        {request kind: list of (latency, ok)}. Updated under lock.
+    lock : threading.Lock
+        Protects results.
+    rng : random.Random
+        Picks the request kind and recording.
+    cold_renders : bool
+        Use a random size for each full size render instead of 800x256.
+    """
+    while time.monotonic() < deadline:
+        recording = rng.choice(recordings)
+        kind = rng.choice(['recordings', 'detections', 'audio_range', 'thumbnail', 'render'])
+        headers = None
+        if kind in ('recordings', 'detections'):
+            url = base_url + '/' + kind + '?' + query
+        elif kind == 'audio_range':
+            first = rng.randrange(max(recording['size'] - 65536, 1))
+            url, headers = base_url + recording['audio'], {'Range': 'bytes={first}-{last}'.format(first=first, last=first + 65535)}
+        elif kind == 'thumbnail':
+            url = base_url + recording['render'] + '?width=160&height=64'
+        elif cold_renders:
+            url = base_url + recording['render'] + '?width={width}&height={height}'.format(width=rng.randrange(400, 1200), height=rng.randrange(128, 384))
+        else:
+            url = base_url + recording['render'] + '?width=800&height=256'
+
+        started = time.monotonic()
+        try:
+            status, _ = fetch(url, headers)
+            ok = status in (200, 206)
+        except (URLError, OSError):
+            ok = False
+        with lock:
+            results.setdefault(kind, []).append((time.monotonic() - started, ok))
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('url', help='base URL of the service e.g. http://localhost:8090')
+    parser.add_argument('--clients', type=int, default=8, help='number of clients making requests at the same time')
+    parser.add_argument('--seconds', type=float, default=30, help='how long to run for')
+    parser.add_argument('--start', help='start of the time range to query (ISO format, default: last 24 hours)')
+    parser.add_argument('--end', help='end of the time range to query (ISO format, default: now)')
+    parser.add_argument('--cached-renders', action='store_true', help='always ask for 800x256 renders so most come from the cache (default: random sizes, so most are rendered)')
+    args = parser.parse_args()
+
+    base_url = args.url.rstrip('/')
+    query = urllib.parse.urlencode({key: value for key, value in (('start', args.start), ('end', args.end)) if value}) # '+' in a UTC offset has to be escaped
+    try:
+        _, body = fetch(base_url + '/recordings?' + query)
+    except (URLError, OSError) as error: # HTTPError (e.g. 400 for a bad --start) is a URLError
+        print("Could not list recordings from {url} > {error}".format(url=base_url, error=error))
+        return 1
+    recordings = json.loads(body)
+    if not recordings:
+        print("No recordings in the time range, nothing to load test with")
+        return 1
+
+    results, lock = {}, threading.Lock()
+    deadline = time.monotonic() + args.seconds
+    threads = [threading.Thread(target=client, args=(base_url, recordings, query, deadline, results, lock, random.Random(i), not args.cached_renders))
+               for i in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print("{clients} clients for {seconds:.0f}s against {url} ({recordings} recordings)".format(clients=args.clients, seconds=args.seconds, url=base_url, recordings=len(recordings)))
+    print("{kind:<12} {requests:>8} {rate:>8} {errors:>7} {p50:>8} {p95:>8} {p99:>8}".format(kind='request', requests='count', rate='per s', errors='errors', p50='p50 ms', p95='p95 ms', p99='p99 ms'))
+    for kind, samples in sorted(results.items()):
+        latencies = [latency * 1e3 for latency, _ in samples]
+        print("{kind:<12} {requests:>8} {rate:>8.1f} {errors:>7} {p50:>8.1f} {p95:>8.1f} {p99:>8.1f}".format(
+            kind=kind, requests=len(samples), rate=len(samples) / args.seconds, errors=sum(not ok for _, ok in samples),
+            p50=percentile(latencies, 0.5), p95=percentile(latencies, 0.95), p99=percentile(latencies, 0.99)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
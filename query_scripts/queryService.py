@@ -0,0 +1,501 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+
+"""Small HTTP service run on the station so recordings and detections can be checked without logging in over SSH"""
+# Endpoints (times are ISO format e.g. 2023-02-08T21:00, sites is a comma separated list of LIDs/SIDs):
+#   GET /recordings?start=...&end=...&sites=...    recordings whose start time is in the range, as JSON
+#   GET /detections?start=...&end=...&sites=...    BirdNET detections and bat calls in the range, as JSON
+#   GET /audio/<date>/<file>.wav                   the recording, supports Range requests (seeking in a browser player)
+#   GET /render/<date>/<file>.wav?width=&height=   spectrogram of the recording as a PNG (small sizes for thumbnails)
+# Audio is served from memory mapped files, renders are kept in a size bounded LRU cache. The service runs at a low
+# CPU priority and only renders a few spectrograms at a time so it doesn't get in the way of recording.
+
+import argparse
+import collections
+import csv
+import datetime
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+import zlib
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, unquote, urlparse
+
+import numpy as np
+
+
+CONFIG_FILE = '/home/bird-pi/ami_setup/system_config.JSON'
+
+# LID__SID__HID__year_month_day__hour_minute_second.wav as written by birdRecording.py/batRecording.py
+RECORDING_NAME = re.compile(r'^(?P<LID>.+?)__(?P<SID>.+?)__(?P<HID>.+?)__(?P<date>\d+_\d+_\d+)__(?P<time>\d+_\d+_\d+)\.wav$')
+DATE_DIR = re.compile(r'^\d{4}_\d{1,2}_\d{1,2}$')
+
+# ===========================================================================================================================
+
+### Finding recordings and detections ###
+
+def date_dir(day):
+    return "%s_%s_%s" % (day.year, day.month, day.day)
+
+
+def parse_recording_name(name):
+    """
+    Returns the details in a recording's file name, or None if it doesn't follow the naming scheme.
+
+    Parameters
+    ----------
+    name : str
+        File name e.g. 'LID_test__SID_test__HID_test__2023_2_8__17_42_7.wav'.
+
+    Returns
+    -------
+    dict or None
+        'LID', 'SID', 'HID' and 'start' (datetime).
+    """
+    match = RECORDING_NAME.match(name)
+    if match is None:
+        return None
+    start = datetime.datetime(*map(int, (match['date'] + '_' + match['time']).split('_')))
+    return {'LID': match['LID'], 'SID': match['SID'], 'HID': match['HID'], 'start': start}
+
+
+def parse_time(value):
+    """
+    Parse an ISO format time from a query. Recordings are named in the station's local time, so a time with a UTC offset
+    (e.g. 2023-02-08T22:00+00:00) is converted to local time and returned without a time zone.
+    """
+    time = datetime.datetime.fromisoformat(value) # ValueError if not ISO format, reported as a bad request
+    if time.tzinfo is not None:
+        time = time.astimezone().replace(tzinfo=None)
+    return time
+
+
+def in_sites(details, sites):
+    return not sites or details['LID'] in sites or details['SID'] in sites
+
+
+def days_between(start, end):
+    day = start.date()
+    while day <= end.date():
+        yield day
+        day += datetime.timedelta(days=1)
+
+
+def list_recordings(raw_audio, start, end, sites):
+    """
+    Returns the recordings starting between start and end, for the given sites.
+
+    Parameters
+    ----------
+    raw_audio : pathlib.Path
+        Directory holding one directory of recordings per day.
+    start, end : datetime
+        Time range.
+    sites : set of str
+        LIDs/SIDs to include, all if empty.
+
+    Returns
+    -------
+    list of dict
+        One entry per recording with its details, size and the URLs to fetch it.
+    """
+    recordings = []
+    for day in days_between(start, end):
+        directory = raw_audio / date_dir(day)
+        if not directory.is_dir():
+            continue
+        for path in sorted(directory.glob('*.wav')):
+            details = parse_recording_name(path.name)
+            if details and start <= details['start'] <= end and in_sites(details, sites):
+                url = '/' + date_dir(day) + '/' + path.name
+                recordings.append(dict(details, start=details['start'].isoformat(), file=path.name,
+                                       size=path.stat().st_size, audio='/audio' + url, render='/render' + url))
+    return recordings
+
+
+def list_detections(analysed_audio, bat_events, start, end, sites):
+    """
+    Returns the BirdNET detections and bat calls between start and end, for the given sites.
+
+    Parameters
+    ----------
+    analysed_audio : pathlib.Path
+        Directory holding one directory of BirdNET results (--rtype r) per day.
+    bat_events : pathlib.Path
+        Directory holding one bat call table (detectBatCalls.py) per day.
+    start, end : datetime
+        Time range.
+    sites : set of str
+        LIDs/SIDs to include, all if empty.
+
+    Returns
+    -------
+    list of dict
+        One entry per detection: 'time', 'file', 'type' ('bird' or 'bat') and what was detected.
+    """
+    detections = []
+    for day in days_between(start, end):
+        for results_file in sorted((analysed_audio / date_dir(day)).glob('*.csv')):
+            with results_file.open(newline='') as fp:
+                for row in csv.DictReader(fp):
+                    details = parse_recording_name(Path(row.get('filepath') or '').name)
+                    if details is None or not in_sites(details, sites):
+                        continue
+                    try:
+                        time = details['start'] + datetime.timedelta(seconds=float(row['start']))
+                        detection = {'type': 'bird', 'time': time.isoformat(), 'file': Path(row['filepath']).name,
+                                     'start_s': float(row['start']), 'end_s': float(row['end']),
+                                     'species': row.get('common_name'), 'scientific_name': row.get('scientific_name'),
+                                     'confidence': float(row['confidence'])}
+                    except (KeyError, TypeError, ValueError): # malformed row e.g. cut short while BirdNET was writing it
+                        continue
+                    if start <= time <= end:
+                        detections.append(detection)
+
+        bat_file = bat_events / (date_dir(day) + '.csv')
+        if bat_file.exists():
+            with bat_file.open(newline='') as fp:
+                for row in csv.DictReader(fp):
+                    details = parse_recording_name(row.get('file') or '')
+                    if details is None or not in_sites(details, sites) or not row.get('start_time'):
+                        continue
+                    try:
+                        time = datetime.datetime.fromisoformat(row['start_time'])
+                        detection = {'type': 'bat', 'time': row['start_time'], 'file': row['file'],
+                                     'start_s': float(row['start_s']), 'duration_ms': float(row['duration_ms']),
+                                     'peak_khz': float(row['peak_khz']), 'snr_db': float(row['snr_db'])}
+                    except (KeyError, TypeError, ValueError):
+                        continue
+                    if start <= time <= end:
+                        detections.append(detection)
+    detections.sort(key=lambda detection: detection['time'])
+    return detections
+
+# ===========================================================================================================================
+
+### Audio files ###
+
+class MappedRecording:
+    """
+    A WAV file mapped into memory, so byte ranges and samples are read straight from the page cache without copying.
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        WAV file to map.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as fp:
+            self.mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = len(self.mm)
+
+    def close(self):
+        try:
+            self.mm.close()
+        except BufferError: # a numpy view is still alive (e.g. after an error), the map is freed once it's gone
+            pass
+
+    def samples(self):
+        """
+        Returns the first channel of the audio as a numpy view of the mapped file, and the sampling rate.
+
+        Returns
+        -------
+        samples : numpy.ndarray
+            Integer samples (strided view, not a copy).
+        rate : int
+            Sampling rate in Hz.
+        """
+        if self.mm[:4] != b'RIFF' or self.mm[8:12] != b'WAVE':
+            raise ValueError('not a WAV file')
+        position, fmt = 12, None
+        while position + 8 <= self.size:
+            chunk_id, chunk_size = struct.unpack_from('<4sI', self.mm, position)
+            if chunk_id == b'fmt ':
+                fmt = struct.unpack_from('<HHIIHH', self.mm, position + 8)
+            elif chunk_id == b'data' and fmt is not None:
+                _, channels, rate, _, _, bits = fmt
+                width = bits // 8
+                if width not in (1, 2, 4):
+                    raise ValueError("can't render {bits} bit audio".format(bits=bits))
+                count = min(chunk_size, self.size - position - 8) // (width * channels)
+                dtype = np.uint8 if width == 1 else '<i{width}'.format(width=width)
+                data = np.frombuffer(self.mm, dtype, count * channels, position + 8)
+                return data[::channels], rate
+            position += 8 + chunk_size + (chunk_size & 1)
+        raise ValueError('no audio data in WAV file')
+
+# ===========================================================================================================================
+
+### Quick-look renders ###
+
+def spectrogram_png(samples, rate, width, height, nfft=512):
+    """
+    Render a spectrogram of the whole recording as a greyscale PNG.
+
+    Only one FFT frame per output column is computed, so rendering a long recording costs the same as a short one.
+
+    Parameters
+    ----------
+    samples : numpy.ndarray
+        Audio samples.
+    rate : int
+        Sampling rate in Hz (only used for the frequency axis, which always runs from 0 to rate/2).
+    width, height : int
+        Image size in pixels.
+    nfft : int
+        FFT size.
+
+    Returns
+    -------
+    bytes
+        The PNG image.
+    """
+    nfft = min(nfft, max(len(samples), 2))
+    starts = np.linspace(0, max(len(samples) - nfft, 0), width).astype(np.int64)
+    frames = samples[starts[:, None] + np.arange(nfft)].astype(np.float32)
+    frames -= frames.mean(axis=1, keepdims=True)
+    power_db = 10 * np.log10(np.abs(np.fft.rfft(frames * np.hanning(nfft), axis=1)) ** 2 + 1e-12)
+
+    # 60 dB of range below the loudest point, high frequencies at the top
+    low = power_db.max() - 60
+    image = np.clip((power_db - low) / 60, 0, 1)
+    rows = np.linspace(image.shape[1] - 1, 0, height).astype(np.int64)
+    pixels = (255 - image[:, rows].T * 255).astype(np.uint8) # dark = loud
+
+    raw = b''.join(b'\x00' + row.tobytes() for row in pixels)
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(raw, 6)) + chunk(b'IEND', b''))
+
+
+class RenderCache:
+    """
+    Least recently used cache of rendered images, limited by the total size of the images.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Once the images add up to more than this the least recently used ones are dropped.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.items:
+                return
+            self.items[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes and self.items:
+                _, dropped = self.items.popitem(last=False)
+                self.size -= len(dropped)
+
+# ===========================================================================================================================
+
+### HTTP ###
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """Handles one request. The server attributes 'settings', 'cache' and 'render_slots' are set up in make_server()."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        parts = [unquote(part) for part in url.path.strip('/').split('/')]
+        try:
+            if parts == ['recordings']:
+                start, end, sites = self._range(query)
+                self._send_json(list_recordings(self.server.settings['raw_audio'], start, end, sites))
+            elif parts == ['detections']:
+                start, end, sites = self._range(query)
+                self._send_json(list_detections(self.server.settings['analysed_audio'], self.server.settings['bat_events'], start, end, sites))
+            elif len(parts) == 3 and parts[0] == 'audio':
+                self._send_audio(self._recording_path(parts[1], parts[2]))
+            elif len(parts) == 3 and parts[0] == 'render':
+                self._send_render(self._recording_path(parts[1], parts[2]), query)
+            else:
+                self.send_error(HTTPStatus.NOT_FOUND)
+        except FileNotFoundError:
+            self.send_error(HTTPStatus.NOT_FOUND)
+        except ValueError as error:
+            self.send_error(HTTPStatus.BAD_REQUEST, str(error))
+        except (BrokenPipeError, ConnectionResetError):
+            pass # client went away (e.g. a player seeking)
+
+    def log_message(self, format, *args):
+        pass # don't fill the station's logs with every request
+
+    def _range(self, query):
+        now = datetime.datetime.now()
+        start = parse_time(query['start']) if 'start' in query else now - datetime.timedelta(days=1)
+        end = parse_time(query['end']) if 'end' in query else now
+        sites = {site for site in query.get('sites', '').split(',') if site}
+        return start, end, sites
+
+    def _recording_path(self, day, name):
+        # only allow names that look like recordings, so requests can't reach anything else on the station
+        if not DATE_DIR.match(day) or RECORDING_NAME.match(name) is None or '/' in name:
+            raise FileNotFoundError(name)
+        path = self.server.settings['raw_audio'] / day / name
+        if not path.is_file():
+            raise FileNotFoundError(name)
+        return path
+
+    def _send_json(self, data):
+        body = json.dumps(data).encode()
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_audio(self, path):
+        if path.stat().st_size == 0: # can't map an empty file, but there is nothing to send anyway
+            self.send_response(HTTPStatus.OK)
+            self.send_header('Content-Type', 'audio/wav')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        recording = MappedRecording(path)
+        try:
+            first, last = 0, recording.size - 1
+            status = HTTPStatus.OK
+            match = re.fullmatch(r'bytes=(\d*)-(\d*)', self.headers.get('Range', ''))
+            if match and (match[1] or match[2]):
+                if match[1]:
+                    first = int(match[1])
+                    last = min(int(match[2]), last) if match[2] else last
+                else: # bytes=-N is the last N bytes
+                    first = max(recording.size - int(match[2]), 0)
+                if first > last:
+                    self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                    self.send_header('Content-Range', 'bytes */{size}'.format(size=recording.size))
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                status = HTTPStatus.PARTIAL_CONTENT
+
+            self.send_response(status)
+            self.send_header('Content-Type', 'audio/wav')
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Length', str(last - first + 1))
+            if status == HTTPStatus.PARTIAL_CONTENT:
+                self.send_header('Content-Range', 'bytes {first}-{last}/{size}'.format(first=first, last=last, size=recording.size))
+            self.end_headers()
+
+            view = memoryview(recording.mm)
+            try:
+                for position in range(first, last + 1, 256 * 1024):
+                    self.wfile.write(view[position:min(position + 256 * 1024, last + 1)])
+            finally:
+                view.release()
+        finally:
+            recording.close()
+
+    def _send_render(self, path, query):
+        width = min(max(int(query.get('width', 800)), 16), 4096)
+        height = min(max(int(query.get('height', 256)), 16), 1024)
+        st = path.stat()
+        if st.st_size == 0: # e.g. arecord failed to start, nothing to render
+            self.send_error(HTTPStatus.CONFLICT, 'recording is empty')
+            return
+        key = (str(path), st.st_mtime_ns, st.st_size, width, height)
+
+        png = self.server.cache.get(key)
+        if png is None:
+            with self.server.render_slots: # only a few renders at once, the rest wait their turn
+                png = self.server.cache.get(key) # another request may have rendered it while this one waited
+                if png is None:
+                    recording = MappedRecording(path)
+                    try:
+                        samples, rate = recording.samples()
+                        png = spectrogram_png(samples, rate, width, height)
+                        del samples # release the view of the map so it can be closed
+                    finally:
+                        recording.close()
+                    self.server.cache.put(key, png)
+
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(png)))
+        self.send_header('Cache-Control', 'max-age=3600')
+        self.end_headers()
+        self.wfile.write(png)
+
+
+def make_server(config, host=None, port=None):
+    """
+    Build the HTTP server from system_config.JSON.
+
+    Parameters
+    ----------
+    config : dict
+        Content of system_config.JSON.
+    host : str, optional
+        Address to listen on, overrides query_service.host.
+    port : int, optional
+        Port to listen on, overrides query_service.port.
+
+    Returns
+    -------
+    http.server.ThreadingHTTPServer
+        Server ready for serve_forever().
+    """
+    service = config['query_service']
+    raw_audio = Path(config['birds']['directory_to_save_audio'])
+    detector = config['bats'].get('detector', {})
+
+    server = ThreadingHTTPServer((host or service['host'], port if port is not None else service['port']), QueryHandler)
+    server.daemon_threads = True
+    server.settings = {'raw_audio': raw_audio,
+                       'analysed_audio': raw_audio.parent / 'analysed_audio',
+                       'bat_events': Path(detector.get('directory_to_save_events', raw_audio.parent / 'bat_events'))}
+    server.cache = RenderCache(int(service.get('render_cache_mb', 32) * 1024 * 1024))
+    server.render_slots = threading.BoundedSemaphore(service.get('max_renders', 1))
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--config', default=CONFIG_FILE, help='path to system_config.JSON')
+    parser.add_argument('--host', help='address to listen on (default: query_service.host)')
+    parser.add_argument('--port', type=int, help='port to listen on (default: query_service.port)')
+    args = parser.parse_args()
+
+    with open(args.config) as fp:
+        config = json.load(fp)
+
+    os.nice(config['query_service'].get('nice', 10)) # recording comes first
+    server = make_server(config, args.host, args.port)
+    print("Query service listening on http://{host}:{port}".format(host=server.server_address[0], port=server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+
+"""Launch a station workload (bird/bat capture, motion or BirdNET analysis) under supervision"""
+# Used by crontab in place of running the workload directly, e.g.
+#   python3 superviseWorkload.py capture
+#   python3 superviseWorkload.py analysis -- --i <raw audio dir> --o <analysed audio dir> --lat <lat> --lon <lon> --rtype r
+#   python3 superviseWorkload.py status
+# The child process (and anything it starts, e.g. arecord) gets the CPU and I/O priority of its workload class, so capture
+# always wins over motion and analysis. Analysis is paused (SIGSTOP) while the audio capture buffer is filling up or the
+# system load is high, and carries on (SIGCONT) once things calm down. Children that hang (no CPU progress) or run past
+# their maximum runtime are killed and restarted. Each workload's resource usage is written to the status directory.
+
+import argparse
+import glob
+import json
+import os
+import re
+import signal
+import sys
+import time
+from pathlib import Path
+
+import psutil
+
+
+CONFIG_FILE = '/home/bird-pi/ami_setup/system_config.JSON'
+
+# Priority for each workload class. Negative nice values and the realtime I/O class need root. Capture is started from
+# the (non root) bird-pi crontab, so it normally gets nice 0 and the highest best-effort I/O level instead - motion and
+# analysis are run below that so capture still comes first without root.
+PRIORITIES = {
+    'capture': {'nice': -10, 'ionice': (psutil.IOPRIO_CLASS_RT, 0)},
+    'motion': {'nice': 5, 'ionice': (psutil.IOPRIO_CLASS_BE, 7)},
+    'analysis': {'nice': 19, 'ionice': (psutil.IOPRIO_CLASS_IDLE, 0)},
+}
+
+# ===========================================================================================================================
+
+### System pressure ###
+
+def capture_buffer_fill(asound_dir='/proc/asound'):
+    """
+    Returns how full the fullest running ALSA capture buffer is (0 = empty, 1 = full and about to overrun).
+
+    Parameters
+    ----------
+    asound_dir : str
+        Location of the ALSA proc files.
+
+    Returns
+    -------
+    float
+        Fraction of the buffer holding samples that arecord has not read yet, 0 if nothing is recording.
+    """
+    fill = 0.0
+    for status_file in glob.glob(os.path.join(asound_dir, 'card*', 'pcm*c', 'sub*', 'status')):
+        try:
+            status = Path(status_file).read_text()
+            hw_params = Path(status_file).with_name('hw_params').read_text()
+        except OSError:
+            continue
+        avail = re.search(r'^avail\s*:\s*(\d+)', status, re.M)
+        buffer_size = re.search(r'^buffer_size:\s*(\d+)', hw_params, re.M)
+        if 'RUNNING' in status and avail and buffer_size:
+            fill = max(fill, int(avail.group(1)) / int(buffer_size.group(1)))
+    return fill
+
+
+def load_per_cpu():
+    """Returns the 1 minute load average divided by the number of CPUs."""
+    return os.getloadavg()[0] / (os.cpu_count() or 1)
+
+
+class PressureGate:
+    """
+    Decides when analysis should be paused, with separate high/low thresholds so it doesn't flap on and off.
+
+    Parameters
+    ----------
+    settings : dict
+        'capture_buffer_high', 'capture_buffer_low', 'load_high' and 'load_low' from the supervisor config.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.paused = False
+
+    def update(self, buffer_fill, load):
+        if not self.paused:
+            self.paused = buffer_fill >= self.settings['capture_buffer_high'] or load >= self.settings['load_high']
+        else:
+            self.paused = not (buffer_fill <= self.settings['capture_buffer_low'] and load <= self.settings['load_low'])
+        return self.paused
+
+# ===========================================================================================================================
+
+### Process tree helpers ###
+
+def process_tree(proc):
+    """Returns the process and all of its descendants that are still alive."""
+    try:
+        return [proc] + proc.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return []
+
+
+def start_priority(workload_class):
+    """
+    Returns a preexec_fn for Popen that gives the child the priority of the workload class before it runs the workload, so
+    it never runs (or starts its own children) at the wrong priority.
+
+    Parameters
+    ----------
+    workload_class : str
+        Key of PRIORITIES.
+    """
+    priority = PRIORITIES[workload_class]
+
+    def preexec():
+        # Runs in the forked child: errors can't be reported from here, set_priority() catches anything that was missed
+        try:
+            os.setpriority(os.PRIO_PROCESS, 0, priority['nice'])
+        except OSError:
+            pass
+        me = psutil.Process()
+        try:
+            me.ionice(*priority['ionice'])
+        except (psutil.AccessDenied, OSError):
+            try:
+                me.ionice(psutil.IOPRIO_CLASS_BE, 0)
+            except (psutil.AccessDenied, OSError):
+                pass
+    return preexec
+
+
+def set_priority(procs, workload_class, done):
+    """
+    Give every process not already in done the priority of the workload class. The child is started with the right
+    priority (see start_priority), this catches up with anything in its tree that changed its own priority.
+
+    Parameters
+    ----------
+    procs : list of psutil.Process
+        Processes to update.
+    workload_class : str
+        Key of PRIORITIES.
+    done : set
+        pids that already have the right priority. Updated in place.
+    """
+    priority = PRIORITIES[workload_class]
+    for proc in procs:
+        if proc.pid in done:
+            continue
+        done.add(proc.pid)
+        try:
+            proc.nice(priority['nice'])
+        except psutil.AccessDenied: # not root, stays at the nice value it was started with
+            pass
+        except psutil.NoSuchProcess:
+            continue
+        try:
+            proc.ionice(*priority['ionice'])
+        except psutil.AccessDenied:
+            # Realtime I/O needs root, fall back to the highest best-effort level
+            try:
+                proc.ionice(psutil.IOPRIO_CLASS_BE, 0)
+            except (psutil.AccessDenied, psutil.NoSuchProcess):
+                pass
+        except psutil.NoSuchProcess:
+            pass
+
+
+def signal_tree(procs, sig):
+    for proc in procs:
+        try:
+            proc.send_signal(sig)
+        except psutil.NoSuchProcess:
+            pass
+
+
+def kill_tree(procs, grace=5):
+    """Terminate the processes, killing any still running after grace seconds."""
+    signal_tree(procs, signal.SIGCONT) # a stopped process can't handle SIGTERM
+    signal_tree(procs, signal.SIGTERM)
+    _, alive = psutil.wait_procs(procs, timeout=grace)
+    signal_tree(alive, signal.SIGKILL)
+    psutil.wait_procs(alive, timeout=grace)
+
+
+def tree_usage(procs, cpu_by_pid=None):
+    """
+    Returns the combined resource usage of a process tree.
+
+    Parameters
+    ----------
+    procs : list of psutil.Process
+        Processes to add up.
+    cpu_by_pid : dict, optional
+        Filled in with {pid: CPU seconds} for each process, so progress can be tracked per process.
+
+    Returns
+    -------
+    dict
+        'cpu_seconds', 'cpu_percent', 'rss_mb', 'read_mb', 'write_mb' and 'processes'.
+    """
+    usage = {'cpu_seconds': 0.0, 'cpu_percent': 0.0, 'rss_mb': 0.0, 'read_mb': 0.0, 'write_mb': 0.0, 'processes': 0}
+    for proc in procs:
+        try:
+            with proc.oneshot():
+                cpu = proc.cpu_times()
+                usage['cpu_seconds'] += cpu.user + cpu.system
+                if cpu_by_pid is not None:
+                    cpu_by_pid[proc.pid] = cpu.user + cpu.system
+                usage['cpu_percent'] += proc.cpu_percent()
+                usage['rss_mb'] += proc.memory_info().rss / 1e6
+                try:
+                    io = proc.io_counters()
+                    usage['read_mb'] += io.read_bytes / 1e6
+                    usage['write_mb'] += io.write_bytes / 1e6
+                except (psutil.AccessDenied, AttributeError):
+                    pass
+                usage['processes'] += 1
+        except psutil.NoSuchProcess:
+            pass
+    return usage
+
+# ===========================================================================================================================
+
+### Supervising ###
+
+class Supervisor:
+    """
+    Runs one workload, restarting it when it hangs or goes over its maximum runtime.
+
+    Parameters
+    ----------
+    name : str
+        Workload name, key of the 'workloads' section of the supervisor config.
+    config : dict
+        The 'supervisor' section of system_config.JSON.
+    extra_args : list of str
+        Appended to the workload command.
+    """
+
+    def __init__(self, name, config, extra_args=()):
+        self.name = name
+        self.config = config
+        self.workload = config['workloads'][name]
+        self.command = list(self.workload['command']) + list(extra_args)
+        self.gate = PressureGate(config['pause_analysis']) if self.workload['class'] == 'analysis' else None
+        self.status_file = Path(config['status_directory']) / (name + '.json')
+        self.proc = None
+        self.stopping = False
+        self.status_failed = False # only report the first failed status write
+
+    def run(self):
+        """Run the workload to completion (restarting it if needed) and return its exit code."""
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        # Workloads run as different users (capture from the bird-pi crontab, motion and analysis with sudo), so the status
+        # directory is shared like /tmp: anyone can add files, only the owner can replace them
+        status_directory = Path(self.config['status_directory'])
+        try:
+            status_directory.mkdir(parents=True, exist_ok=True)
+            if status_directory.stat().st_uid == os.geteuid():
+                status_directory.chmod(0o1777)
+        except OSError as error:
+            print("Supervisor > can't use status directory {directory} > {error}".format(directory=status_directory, error=error))
+
+        restarts = 0
+        while True:
+            returncode, hung = self._run_once(restarts)
+            if not hung or self.stopping:
+                break
+            if restarts >= self.workload.get('max_restarts', 0):
+                print("Supervisor > {name} hung and has no restarts left".format(name=self.name))
+                break
+            restarts += 1
+            print("Supervisor > restarting {name} ({restarts} of {max_restarts})".format(name=self.name, restarts=restarts, max_restarts=self.workload['max_restarts']))
+        return returncode
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+        if self.proc is not None:
+            kill_tree(process_tree(self.proc))
+
+    def _run_once(self, restarts):
+        popen = self.proc = psutil.Popen(self.command, preexec_fn=start_priority(self.workload['class']))
+        print("Supervisor > started {name} pid = {pid}".format(name=self.name, pid=popen.pid))
+
+        started = last_progress = last_poll = time.monotonic()
+        active = 0.0 # seconds run while not paused
+        cpu_by_pid = {}
+        prioritised = set()
+        usage = {}
+        known = {} # keep the same Process objects between polls so cpu_percent() has something to compare against
+        paused = hung = False
+        poll = self.config.get('poll_seconds', 2)
+        max_runtime = self.workload.get('max_runtime')
+        hang_after = self.workload.get('hang_after')
+
+        while popen.poll() is None:
+            procs = [known.setdefault(proc.pid, proc) for proc in process_tree(popen)]
+            set_priority(procs, self.workload['class'], prioritised)
+            last_cpu, cpu_by_pid = cpu_by_pid, {}
+            usage = tree_usage(procs, cpu_by_pid)
+            now = time.monotonic()
+            if not paused:
+                active += now - last_poll
+            last_poll = now
+
+            if self.gate is not None:
+                buffer_fill, load = capture_buffer_fill(), load_per_cpu()
+                if self.gate.update(buffer_fill, load) != paused:
+                    paused = self.gate.paused
+                    signal_tree(procs, signal.SIGSTOP if paused else signal.SIGCONT)
+                    print("Supervisor > {action} {name} (capture buffer {fill:.0%}, load {load:.2f} per CPU)".format(
+                        action='paused' if paused else 'resumed', name=self.name, fill=buffer_fill, load=load))
+
+            # Hung = no process in the tree used any CPU for hang_after seconds (compared per process, as the total drops
+            # when a busy child exits). New processes count as progress. Time spent paused doesn't count.
+            if paused or any(seconds > last_cpu.get(pid, -1.0) for pid, seconds in cpu_by_pid.items()):
+                last_progress = now
+            if hang_after and now - last_progress > hang_after:
+                print("Supervisor > {name} has used no CPU for {seconds}s, killing it".format(name=self.name, seconds=hang_after))
+                hung = True
+            elif max_runtime and active > max_runtime:
+                print("Supervisor > {name} has run for more than {seconds}s, killing it".format(name=self.name, seconds=max_runtime))
+                hung = True
+            if hung:
+                kill_tree(procs)
+                break
+
+            self._write_status(dict(usage, pid=popen.pid, paused=paused, restarts=restarts, runtime=round(now - started, 1)))
+            time.sleep(poll)
+
+        returncode = popen.wait()
+        if returncode is None: # already reaped by kill_tree
+            returncode = popen.returncode if popen.returncode is not None else 1
+        self._write_status(dict(usage, pid=popen.pid, returncode=returncode, hung=hung, restarts=restarts,
+                                runtime=round(time.monotonic() - started, 1)))
+        print("Supervisor > {name} finished with exit code {returncode}".format(name=self.name, returncode=returncode))
+        return returncode, hung
+
+    def _write_status(self, status):
+        status = dict(status, workload=self.name, updated=time.time(), command=self.command)
+        tmp_file = self.status_file.with_name(self.status_file.name + '.tmp')
+        try:
+            tmp_file.write_text(json.dumps(status, indent=3))
+            os.replace(tmp_file, self.status_file)
+        except OSError as error: # never stop supervising because the status can't be written
+            if not self.status_failed:
+                print("Supervisor > can't write status file {status_file} > {error}".format(status_file=self.status_file, error=error))
+            self.status_failed = True
+
+
+def print_status(config):
+    """Print the latest resource usage of every workload."""
+    for status_file in sorted(Path(config['status_directory']).glob('*.json')):
+        with status_file.open() as fp:
+            status = json.load(fp)
+        if 'returncode' in status:
+            state = "finished ({returncode})".format(returncode=status['returncode'])
+        else:
+            state = 'paused' if status['paused'] else 'running'
+        print("{workload:<10} {state:<14} pid {pid:<7} runtime {runtime:>8}s  cpu {cpu:>5.1f}%  rss {rss:>7.1f}MB  read {read:>8.1f}MB  write {write:>8.1f}MB  restarts {restarts}".format(
+            workload=status['workload'], state=state, pid=status['pid'], runtime=status['runtime'],
+            cpu=status.get('cpu_percent', 0), rss=status.get('rss_mb', 0), read=status.get('read_mb', 0),
+            write=status.get('write_mb', 0), restarts=status['restarts']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('workload', help="workload to run (a key of supervisor.workloads in system_config.JSON) or 'status'")
+    parser.add_argument('args', nargs='*', help='extra arguments for the workload command (put them after --)')
+    parser.add_argument('--config', default=CONFIG_FILE, help='path to system_config.JSON')
+    args = parser.parse_args()
+
+    with open(args.config) as fp:
+        config = json.load(fp)['supervisor']
+
+    if args.workload == 'status':
+        print_status(config)
+        return 0
+    return Supervisor(args.workload, config, args.args).run()
+
+
+if __name__ == "__main__":
+    sys.exit(main())